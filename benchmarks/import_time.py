@@ -0,0 +1,70 @@
+"""Measures the time of `import lyza` in fresh interpreters and checks that the
+heavy optional dependencies are not imported with the package.
+
+    python benchmarks/import_time.py --repeat 10 --max-time 0.5
+"""
+
+import argparse
+import subprocess
+import sys
+
+import numpy as np
+
+DEFERRED_MODULES = ["sympy", "progressbar", "matplotlib"]
+
+MEASURE_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import lyza
+print(time.perf_counter() - start)
+print(",".join(m for m in %r if m in sys.modules))
+""" % (DEFERRED_MODULES,)
+
+
+def measure_import_time():
+    output = subprocess.check_output([sys.executable, "-c", MEASURE_SCRIPT])
+    lines = output.decode().splitlines()
+    loaded = [i for i in lines[1].split(",") if i] if len(lines) > 1 else []
+    return float(lines[0]), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--max-time",
+        type=float,
+        default=None,
+        help="Exit with an error if the median import time exceeds this",
+    )
+    args = parser.parse_args()
+
+    times = []
+    loaded_modules = set()
+
+    for i in range(args.repeat):
+        import_time, loaded = measure_import_time()
+        times.append(import_time)
+        loaded_modules.update(loaded)
+
+    median = np.median(times)
+    print(
+        "import lyza: median %.3f s, min %.3f s, max %.3f s over %d runs"
+        % (median, np.min(times), np.max(times), args.repeat)
+    )
+
+    failed = False
+
+    if loaded_modules:
+        print("Imported eagerly: %s" % ", ".join(sorted(loaded_modules)))
+        failed = True
+
+    if args.max_time is not None and median > args.max_time:
+        print("Median import time exceeds %.3f s" % args.max_time)
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
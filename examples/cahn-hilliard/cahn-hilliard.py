@@ -173,6 +173,9 @@ if __name__ == "__main__":
     b = CahnHilliardResidualVector(mesh, FUNCTION_SIZE, dof_ordering=DOF_ORDERING)
     dirichlet_bcs = []
 
+    # Output is written in the background while the next step is solved
+    writer = AsyncVTKWriter()
+
     t = 0
     count = 0
     while t < T_MAX:
@@ -182,8 +185,6 @@ if __name__ == "__main__":
                 a, b, dirichlet_bcs, update_function=update_function, initial=u
             )
 
-        ofile = VTKFile(os.path.join(OUTPUT_DIR, "out_cahn_hilliard_%05d.vtk" % count))
-
         c = u.separate_components([0])
         mu = u.separate_components([1])
 
@@ -195,7 +196,13 @@ if __name__ == "__main__":
         c.set_label("c")
         mu.set_label("mu")
 
-        ofile.write(mesh, [c, mu])
+        writer.submit(
+            os.path.join(OUTPUT_DIR, "out_cahn_hilliard_%05d.vtk" % count),
+            mesh,
+            [c, mu],
+        )
 
         t += DT
         count += 1
+
+    writer.close()
@@ -1,6 +1,4 @@
 import os
-import numpy as np
-from math import sqrt
 from lyza import *
 
 import logging
@@ -49,87 +47,7 @@ load_position_right = (
 )
 
 
-def deviatoric(A):
-    dev = A - 1 / 3 * np.trace(A) * np.eye(3)
-    return dev
-
-
-class Calculator(CellIterator):
-    def init_quantities(self):
-        self.mesh.quantities["SIG"] = CellQuantity(self.mesh, (3, 3))
-        self.mesh.quantities["CTENSOR"] = CellQuantity(self.mesh, (3, 3, 3, 3))
-
-        self.mesh.quantities["EPSP"] = CellQuantity(self.mesh, (3, 3))
-        self.mesh.quantities["ALPHA"] = CellQuantity(self.mesh, (1, 1))
-
-    def iterate(self, cell):
-
-        EPS_arr = self.mesh.quantities["EPS"].get_quantity(cell)
-        EPSPN_arr = self.mesh.quantities["EPSPN"].get_quantity(cell)
-        ALPHAN_arr = self.mesh.quantities["ALPHAN"].get_quantity(cell)
-
-        self.mesh.quantities["SIG"].reset_quantity_by_cell(cell)
-        self.mesh.quantities["CTENSOR"].reset_quantity_by_cell(cell)
-        self.mesh.quantities["EPSP"].reset_quantity_by_cell(cell)
-        self.mesh.quantities["ALPHA"].reset_quantity_by_cell(cell)
-
-        for idx in range(len(EPS_arr)):
-            EPS = EPS_arr[idx]
-            EPSPN = EPSPN_arr[idx]
-            ALPHAN = ALPHAN_arr[idx]
-
-            SIG, CTENSOR, EPSP, ALPHA = self.material(EPS, EPSPN, ALPHAN)
-
-            self.mesh.quantities["SIG"].add_quantity_by_cell(cell, SIG)
-            self.mesh.quantities["CTENSOR"].add_quantity_by_cell(cell, CTENSOR)
-            self.mesh.quantities["EPSP"].add_quantity_by_cell(cell, EPSP)
-            self.mesh.quantities["ALPHA"].add_quantity_by_cell(cell, ALPHA)
-
-    def material(self, eps, eps_p_n, alpha_n):
-        tr_eps = np.trace(eps)
-        eps_dev = deviatoric(eps)
-        I = np.eye(3)
-
-        sigma_dev_tr = 2.0 * MU * (eps_dev - eps_p_n)
-        beta_tr = H_ISO * alpha_n
-
-        # xi_tr = sigma_dev_tr - beta_tr
-        xi_tr = sigma_dev_tr
-        norm_xi_tr = np.linalg.norm(xi_tr)
-
-        phi_tr = norm_xi_tr - sqrt(2 / 3) * (Y0 + beta_tr)
-
-        if phi_tr <= 0:  # elastic step
-            sigma_dev = sigma_dev_tr
-            beta = beta_tr
-            C_dev = 2 * MU * mechanics.PROJECTION4
-        else:  # elastic-plastic step
-            n = xi_tr / norm_xi_tr
-            gamma = phi_tr / (2 * MU + (2 / 3) * H_ISO)
-            sigma_dev = sigma_dev_tr - 2 * MU * gamma * n
-            beta = beta_tr + H_ISO * gamma * sqrt(2 / 3)
-
-            n_dyadic_n = np.einsum("ij,kl->ijkl", n, n)
-            c1 = 1 - 1 / (1 + H_ISO / (3 * MU)) * phi_tr / norm_xi_tr
-            c2 = 1 / (1 + H_ISO / (3 * MU)) * (1 - phi_tr / norm_xi_tr)
-            C_dev = 2 * MU * c1 * mechanics.PROJECTION4 - 2 * MU * c2 * n_dyadic_n
-
-        sigma = KAPPA * tr_eps * I + sigma_dev
-        C = KAPPA * mechanics.IDENTITY_DYADIC_IDENTITY + C_dev
-
-        eps_p = eps_p_n + (sigma_dev_tr - sigma_dev) / (2 * MU)
-        alpha = beta / H_ISO
-
-        # print(eps_p-eps_p.T)
-        # print(eps_p_n)
-        # print(phi_tr, norm_xi_tr)
-
-        # Linear elastic
-        # sigma = KAPPA*tr_eps*I + 2*MU*eps_dev
-        # C = KAPPA*IdI + 2*MU*P
-
-        # import ipdb; ipdb.set_trace()
-        return sigma, C, eps_p, alpha
+MATERIAL = mechanics.J2Plasticity(KAPPA, MU, Y0, H_ISO)
 
 
 def update_function(mesh, u):
@@ -137,8 +55,8 @@ def update_function(mesh, u):
     projector.set_param(u, "EPS", SPATIAL_DIMENSION)
     projector.execute()
 
-    calculator = Calculator(mesh, u.function_size)
-    calculator.init_quantities()
+    calculator = iterators.MaterialUpdater(mesh, u.function_size)
+    calculator.set_param(MATERIAL)
     calculator.execute()
 
 
@@ -155,6 +73,9 @@ if __name__ == "__main__":
     a = matrix_assemblers.InelasticityJacobianMatrix(mesh, FUNCTION_SIZE)
     b_res = vector_assemblers.InelasticityResidualVector(mesh, FUNCTION_SIZE)
 
+    # Output is written in the background while the next step is solved
+    writer = AsyncVTKWriter()
+
     for idx, load in enumerate(LOADS):
         b_1 = vector_assemblers.PointLoadVector(mesh, FUNCTION_SIZE)
         b_1.set_param(load_position_left, [0.0, 0.0, -load])
@@ -188,12 +109,16 @@ if __name__ == "__main__":
         mesh.quantities["EPSPN"] = mesh.quantities["EPSP"]
         mesh.quantities["ALPHAN"] = mesh.quantities["ALPHA"]
 
-        ofile = VTKFile(os.path.join(OUTPUT_DIR, "out_plasticity_%04d.vtk" % idx))
-
         u.set_label("u")
         f.set_label("f")
         sigma.set_label("sigma")
         eps_p.set_label("eps_p")
         alpha.set_label("alpha")
 
-        ofile.write(mesh, [u, f, sigma, eps_p, alpha])
+        writer.submit(
+            os.path.join(OUTPUT_DIR, "out_plasticity_%04d.vtk" % idx),
+            mesh,
+            [u, f, sigma, eps_p, alpha],
+        )
+
+    writer.close()
@@ -1,6 +1,4 @@
 import os
-import numpy as np
-from math import sqrt
 from lyza import *
 
 import logging
@@ -39,51 +37,7 @@ left_boundary = lambda x, t: x[0] <= 1e-12
 load_position = lambda x, t: x[0] > LENGTH - 1e-12
 
 
-def deviatoric(A):
-    dev = A - 1 / 3 * np.trace(A) * np.eye(3)
-    return dev
-
-
-class Calculator(CellIterator):
-    def init_quantities(self):
-        self.mesh.quantities["SIG"] = CellQuantity(self.mesh, (3, 3))
-        self.mesh.quantities["CTENSOR"] = CellQuantity(self.mesh, (3, 3, 3, 3))
-        self.mesh.quantities["ALPHA"] = CellQuantity(self.mesh, (3, 3))
-
-    def iterate(self, cell):
-
-        EPS_arr = self.mesh.quantities["EPS"].get_quantity(cell)
-        ALPHAN_arr = self.mesh.quantities["ALPHAN"].get_quantity(cell)
-
-        self.mesh.quantities["SIG"].reset_quantity_by_cell(cell)
-        self.mesh.quantities["CTENSOR"].reset_quantity_by_cell(cell)
-        self.mesh.quantities["ALPHA"].reset_quantity_by_cell(cell)
-
-        for idx in range(len(EPS_arr)):
-            EPS = EPS_arr[idx]
-            ALPHAN = ALPHAN_arr[idx]
-
-            SIG, CTENSOR, ALPHA = self.material(EPS, ALPHAN)
-
-            self.mesh.quantities["SIG"].add_quantity_by_cell(cell, SIG)
-            self.mesh.quantities["CTENSOR"].add_quantity_by_cell(cell, CTENSOR)
-            self.mesh.quantities["ALPHA"].add_quantity_by_cell(cell, ALPHA)
-
-    def material(self, eps, alpha_n):
-        tr_eps = np.trace(eps)
-        eps_dev = deviatoric(eps)
-        I = np.eye(3)
-
-        tau = ETA / 2 / MU1
-
-        alpha = 1 / (1 + DT / tau) * (alpha_n + DT / tau * eps_dev)
-        sigma = KAPPA * tr_eps * I + 2 * MU0 * eps_dev + 2 * MU1 * (eps_dev - alpha)
-        C = (
-            KAPPA * mechanics.IDENTITY_DYADIC_IDENTITY
-            + (2 * MU0 + 2 * MU1 / (1 + DT / tau)) * mechanics.PROJECTION4
-        )
-
-        return sigma, C, alpha
+MATERIAL = mechanics.LinearViscoelasticity(KAPPA, MU0, MU1, ETA, DT)
 
 
 def update_function(mesh, u):
@@ -91,8 +45,8 @@ def update_function(mesh, u):
     projector.set_param(u, "EPS", SPATIAL_DIMENSION)
     projector.execute()
 
-    calculator = Calculator(mesh, u.function_size)
-    calculator.init_quantities()
+    calculator = iterators.MaterialUpdater(mesh, u.function_size)
+    calculator.set_param(MATERIAL)
     calculator.execute()
 
 
@@ -108,6 +62,9 @@ if __name__ == "__main__":
     a = matrix_assemblers.InelasticityJacobianMatrix(mesh, FUNCTION_SIZE)
     b_res = vector_assemblers.InelasticityResidualVector(mesh, FUNCTION_SIZE)
 
+    # Output is written in the background while the next step is solved
+    writer = AsyncVTKWriter()
+
     t = 0
     count = 0
     while t < T_MAX:
@@ -137,14 +94,18 @@ if __name__ == "__main__":
         # Update history variables
         mesh.quantities["ALPHAN"] = mesh.quantities["ALPHA"]
 
-        ofile = VTKFile(os.path.join(OUTPUT_DIR, "out_creep_%04d.vtk" % count))
-
         u.set_label("u")
         f.set_label("f")
         sigma.set_label("sigma")
         eps_p.set_label("eps_p")
 
-        ofile.write(mesh, [u, f, sigma, eps_p])
+        writer.submit(
+            os.path.join(OUTPUT_DIR, "out_creep_%04d.vtk" % count),
+            mesh,
+            [u, f, sigma, eps_p],
+        )
 
         t += DT
         count += 1
+
+    writer.close()
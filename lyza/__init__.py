@@ -1,17 +1,76 @@
+import importlib
+import sys
+
 from lyza.solver import solve, nonlinear_solve, apply_bcs
 from lyza.function import Function
 from lyza.boundary_condition import DirichletBC, join_boundaries
 from lyza.domain import Domain
-from lyza.vtk import VTKFile
+from lyza.vtk import VTKFile, VTUFile, AsyncVTKWriter, VTKTimeSeries
 from lyza.cell_quantity import CellQuantity
 from lyza.analytic_solution import AnalyticSolution, get_analytic_solution_vector
 from lyza.assembler import MatrixAssembler, VectorAssembler
 from lyza.cell_iterator import CellIterator
+from lyza.parallel import set_assembly_backend
+
+# Imported on first attribute access, so that scripts only pay for what they use
+LAZY_SUBMODULES = [
+    "meshes",
+    "error",
+    "matrix_assemblers",
+    "vector_assemblers",
+    "iterators",
+    "time_integration",
+    "mechanics",
+    "mesh",
+    "node",
+    "cell",
+    "cells",
+    "helper",
+    "integrator",
+    "partition_system",
+]
+
+__all__ = [
+    "solve",
+    "nonlinear_solve",
+    "apply_bcs",
+    "Function",
+    "DirichletBC",
+    "join_boundaries",
+    "Domain",
+    "VTKFile",
+    "VTUFile",
+    "AsyncVTKWriter",
+    "VTKTimeSeries",
+    "CellQuantity",
+    "AnalyticSolution",
+    "get_analytic_solution_vector",
+    "MatrixAssembler",
+    "VectorAssembler",
+    "CellIterator",
+    "set_assembly_backend",
+    "analytic_solution",
+    "assembler",
+    "boundary_condition",
+    "cell_batch",
+    "cell_iterator",
+    "cell_quantity",
+    "domain",
+    "function",
+    "linear_solvers",
+    "parallel",
+    "solver",
+    "sparsity",
+    "vtk",
+    "lyza",
+] + LAZY_SUBMODULES
+
+
+def __getattr__(name):
+    if name in LAZY_SUBMODULES:
+        return importlib.import_module("lyza." + name)
+    elif name == "lyza":
+        # Star imports have always exposed the package itself
+        return sys.modules[__name__]
 
-import lyza.meshes
-import lyza.error
-import lyza.matrix_assemblers
-import lyza.vector_assemblers
-import lyza.iterators
-import lyza.time_integration
-import lyza.mechanics
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,10 +1,11 @@
-import sympy as sp
 import numpy as np
 import itertools
 
 
 class AnalyticSolution:
     def __init__(self, u, n_eqn, n_dim, simplify=False):
+        import sympy as sp
+
         self.simplify = simplify
         self.n_eqn = n_eqn
         self.n_dim = n_dim
@@ -21,12 +22,14 @@ class AnalyticSolution:
 
         self.u = u(self.position)
         if self.simplify:
-            self.u = simplify(self.u)
+            self.u = sp.simplify(self.u)
 
     def get_rhs_expression(self):
         pass
 
     def get_rhs_function(self):
+        import sympy as sp
+
         f_expr = self.get_force_expression()
         if self.simplify:
             f_expr = sp.simplify(f_expr)
@@ -42,6 +45,8 @@ class AnalyticSolution:
         return result
 
     def get_analytic_solution_function(self):
+        import sympy as sp
+
         # u_expr = self.get_ana_expression()
 
         lambdas = [sp.lambdify(self.position, i) for i in self.u]
@@ -52,6 +57,8 @@ class AnalyticSolution:
         return result
 
     def get_gradient_expression(self):
+        import sympy as sp
+
         gradient = sp.zeros(self.n_eqn, self.n_dim)
 
         for i, j in itertools.product(range(self.n_eqn), range(self.n_dim)):
@@ -60,6 +67,8 @@ class AnalyticSolution:
         return gradient
 
     def get_gradient_function(self):
+        import sympy as sp
+
         gradient_expr = self.get_gradient_expression()
 
         lambdas = []
@@ -1,13 +1,57 @@
 import numpy as np
 import logging
 import time
+import threading
 from lyza.cell_iterator import CellIterator
+from lyza.sparsity import SparsityPattern
+from lyza.cell_batch import CellBatch
+from lyza.parallel import (
+    get_assembly_backend,
+    color_cells,
+    split_indices,
+    run_colored,
+    run_in_processes,
+)
 
 
 class Assembler(CellIterator):
     def assemble(self):
         raise Exception("Do not use base class")
 
+    def get_colored_batches(self, n_workers):
+        """Returns a list of batches for every color, where cells of the same
+        color share no dofs. Each batch is split into up to n_workers parts"""
+        cell_indices = np.array(self.get_cell_indices(), dtype=np.int64)
+        coloring = getattr(self, "cell_coloring", None)
+
+        if coloring is None or not np.array_equal(coloring[0], cell_indices):
+            coloring = (cell_indices, color_cells(cell_indices, self.cell_dofs))
+            self.cell_coloring = coloring
+
+        colors = coloring[1]
+        result = []
+
+        for color in range(colors.max() + 1 if len(colors) > 0 else 0):
+            result.append(
+                [
+                    CellBatch(self.mesh, chunk, self.cell_dofs)
+                    for batch in self.get_cell_batches(cell_indices[colors == color])
+                    for chunk in split_indices(batch.cell_indices, n_workers)
+                ]
+            )
+
+        return result
+
+    def get_partitioned_batches(self, n_partitions):
+        """Splits the cells into contiguous partitions and returns the cell
+        indices of the batches of every partition"""
+        cell_indices = np.array(self.get_cell_indices(), dtype=np.int64)
+
+        return [
+            [batch.cell_indices for batch in self.get_cell_batches(partition)]
+            for partition in split_indices(cell_indices, n_partitions)
+        ]
+
     def __add__(self, a):
         if isinstance(a, Assembler):
             return AggregateAssembler([self, a])
@@ -24,8 +68,75 @@ class AggregateAssembler(Assembler):
         self.function_size = self.assemblers[0].function_size
         self.node_dofs = self.assemblers[0].node_dofs
 
-    def assemble(self):
-        return sum([i.assemble() for i in self.assemblers])
+    def assemble(self, **kwargs):
+        backend, n_workers = get_assembly_backend()
+        n_dofs = set([len(i.mesh.nodes) * i.function_size for i in self.assemblers])
+
+        # Members of the same kind are accumulated into a single global array
+        if len(n_dofs) == 1:
+            n_dofs = n_dofs.pop()
+
+            if all([isinstance(i, MatrixAssembler) for i in self.assemblers]):
+                if kwargs.get("dense", False):
+                    return self.assemble_dense_matrix(n_dofs)
+                elif backend == "serial":
+                    return self.assemble_sparse_matrix(n_dofs)
+            elif all([isinstance(i, VectorAssembler) for i in self.assemblers]):
+                if not kwargs:
+                    return self.assemble_vector(n_dofs)
+
+        return sum([i.assemble(**kwargs) for i in self.assemblers])
+
+    def assemble_sparse_matrix(self, n_dofs):
+        logging.debug("Beginning to assemble aggregate matrix")
+        start_time = time.time()
+
+        member_batches = [i.get_cell_batches() for i in self.assemblers]
+        cell_indices = [
+            idx for batches in member_batches for b in batches for idx in b.cell_indices
+        ]
+        pattern = getattr(self, "sparsity_pattern", None)
+
+        # The union of the member patterns, where cells can appear repeatedly
+        if pattern is None or not pattern.matches(cell_indices, n_dofs):
+            dofmaps = [
+                dofmap
+                for batches in member_batches
+                for batch in batches
+                for dofmap in batch.dofs
+            ]
+            pattern = SparsityPattern(cell_indices, dofmaps, n_dofs)
+            self.sparsity_pattern = pattern
+
+        values = np.empty(pattern.n_entries)
+
+        position = 0
+        for assembler, batches in zip(self.assemblers, member_batches):
+            position = assembler.write_element_matrices(batches, values, position)
+
+        result = pattern.create_matrix(values)
+
+        logging.debug(
+            "Aggregate matrix assembled in %f sec" % (time.time() - start_time)
+        )
+
+        return result
+
+    def assemble_dense_matrix(self, n_dofs):
+        result = np.zeros((n_dofs, n_dofs))
+
+        for assembler in self.assemblers:
+            assembler.assemble_dense(n_dofs, result=result)
+
+        return result
+
+    def assemble_vector(self, n_dofs):
+        result = np.zeros((n_dofs, 1))
+
+        for assembler in self.assemblers:
+            assembler.assemble_into(result)
+
+        return result
 
     def __add__(self, a):
         if isinstance(a, Assembler):
@@ -37,31 +148,217 @@ class AggregateAssembler(Assembler):
 
 
 class MatrixAssembler(Assembler):
+    # Element matrices that depend only on the cell geometry, the quadrature
+    # degree and get_cache_parameters() can be reused between congruent cells
+    cacheable = False
+    element_cache = None
+
     def calculate_element_matrix(self, cell):
         raise Exception("Do not use base class")
 
-    def assemble(self):
+    def set_element_cache(self, enabled=True, rtol=1e-10):
+        """Reuses the element matrix of cells whose node coordinates relative to
+        their first node agree within rtol times the mesh size"""
+        if enabled and not self.cacheable:
+            raise Exception(
+                "Element matrices of %s cannot be cached" % type(self).__name__
+            )
+
+        self.element_cache = {} if enabled else None
+        self.element_cache_lock = threading.Lock()
+        self.element_cache_rtol = rtol
+        self.element_cache_hits = 0
+        self.element_cache_misses = 0
+
+    def get_cache_parameters(self):
+        "Returns a hashable signature of the parameters of the element matrices"
+        return ()
+
+    def calculate_element_matrices(self, batch):
+        "Returns an array with shape (n_cell, n_dof, n_dof)"
+        return np.array([self.calculate_element_matrix(cell) for cell in batch.cells])
+
+    def get_element_matrices(self, batch):
+        if self.element_cache is not None and batch.reference is not None:
+            return self.get_cached_element_matrices(batch)
+        else:
+            return self.evaluate_element_matrices(batch)
+
+    def evaluate_element_matrices(self, batch):
+        if self.has_batched_kernel(
+            "calculate_element_matrix", "calculate_element_matrices"
+        ):
+            return self.calculate_element_matrices(batch)
+        else:
+            return MatrixAssembler.calculate_element_matrices(self, batch)
+
+    def get_cached_element_matrices(self, batch):
+        X = self.mesh.coordinates[batch.node_indices]
+        tolerance = self.element_cache_rtol * max(np.ptp(self.mesh.coordinates), 1e-300)
+
+        # Translated cells have the same signature
+        signatures = np.round((X - X[:, :1]) / tolerance).astype(np.int64)
+        signatures = signatures.reshape(len(batch), -1)
+        unique_signatures, first, inverse = np.unique(
+            signatures, axis=0, return_index=True, return_inverse=True
+        )
+
+        # The signatures are only comparable for the same tolerance, which
+        # changes when the mesh is moved or rescaled
+        batch_key = (
+            batch.cell_type,
+            batch.quadrature_degree,
+            batch.dofs.shape[1],
+            tolerance,
+            self.get_cache_parameters(),
+        )
+        keys = [batch_key + (i.tobytes(),) for i in unique_signatures]
+
+        # Batches can be assembled concurrently by the threads backend. The
+        # misses are evaluated outside the lock, so two threads may compute the
+        # same entry, which is harmless
+        with self.element_cache_lock:
+            missing = [
+                idx for idx, key in enumerate(keys) if key not in self.element_cache
+            ]
+
+        missing_matrices = []
+        if missing:
+            sub_batch = CellBatch(
+                self.mesh, batch.cell_indices[first[missing]], self.cell_dofs
+            )
+            missing_matrices = self.evaluate_element_matrices(sub_batch)
+
+        with self.element_cache_lock:
+            for idx, matrix in zip(missing, missing_matrices):
+                self.element_cache[keys[idx]] = matrix
+
+            self.element_cache_misses += len(missing)
+            self.element_cache_hits += len(batch) - len(missing)
+
+            unique_matrices = np.array([self.element_cache[key] for key in keys])
+
+        return unique_matrices[inverse.reshape(-1)]
+
+    def assemble(self, dense=False):
         n_dofs = len(self.mesh.nodes) * self.function_size
-        result = np.zeros((n_dofs, n_dofs))
 
         logging.debug("Beginning to assemble matrix")
         start_time = time.time()
 
-        for idx, cell in enumerate(self.mesh.cells):
-            if not self.domain.is_subset(cell):
-                continue
+        if dense:
+            result = self.assemble_dense(n_dofs)
+        else:
+            result = self.assemble_sparse(n_dofs)
 
-            elem_matrix = self.calculate_element_matrix(cell)
-            dofmap = self.cell_dofs[idx]
+        logging.debug("Matrix assembled in %f sec" % (time.time() - start_time))
 
-            result[np.ix_(dofmap, dofmap)] += elem_matrix
+        return result
 
-            # for i, I in enumerate(dofmap):
-            #     for j, J in enumerate(dofmap):
-            #         result[I, J] += elem_matrix[i,j]
+    def assemble_sparse(self, n_dofs):
+        backend, n_workers = get_assembly_backend()
 
-            # print(result[0:4,0:4])
-        logging.debug("Matrix assembled in %f sec" % (time.time() - start_time))
+        if backend == "threads":
+            return self.assemble_sparse_threaded(n_dofs, n_workers)
+        elif backend == "processes":
+            return self.assemble_sparse_processes(n_dofs, n_workers)
+
+        batches = self.get_cell_batches()
+        cell_indices = [idx for batch in batches for idx in batch.cell_indices]
+        pattern = self.get_sparsity_pattern(cell_indices, n_dofs)
+
+        # Only the values change between assemblies, the structure is reused
+        values = np.empty(pattern.n_entries)
+        self.write_element_matrices(batches, values, 0)
+
+        return pattern.create_matrix(values)
+
+    def write_element_matrices(self, batches, values, position):
+        """Writes the flattened element matrices of the batches to values from
+        position on and returns the position after them"""
+        for batch in batches:
+            elem_matrices = self.get_element_matrices(batch)
+            n_entries = elem_matrices.size
+
+            values[position : position + n_entries] = elem_matrices.ravel()
+            position += n_entries
+
+        return position
+
+    def assemble_sparse_threaded(self, n_dofs, n_workers):
+        batches_by_color = self.get_colored_batches(n_workers)
+        batches = [batch for batches in batches_by_color for batch in batches]
+        cell_indices = [idx for batch in batches for idx in batch.cell_indices]
+        pattern = self.get_sparsity_pattern(cell_indices, n_dofs)
+
+        # Offset of the entries of every batch in the scatter array of the pattern
+        offsets = np.cumsum(
+            [0] + [batch.dofs.shape[1] ** 2 * len(batch) for batch in batches]
+        )
+        tasks_by_color = []
+        position = 0
+        for batches in batches_by_color:
+            tasks = []
+            for batch in batches:
+                tasks.append((batch, offsets[position]))
+                position += 1
+            tasks_by_color.append(tasks)
+
+        data = np.zeros(pattern.nnz)
+
+        # Cells of a color share no dofs, so their entries in data are distinct
+        def scatter(task):
+            batch, offset = task
+            elem_matrices = self.get_element_matrices(batch).ravel()
+            data[pattern.scatter[offset : offset + elem_matrices.size]] += elem_matrices
+
+        run_colored(tasks_by_color, scatter, n_workers)
+
+        return pattern.create_matrix_from_data(data)
+
+    def assemble_sparse_processes(self, n_dofs, n_workers):
+        partitions = self.get_partitioned_batches(n_workers)
+        cell_indices = [idx for batches in partitions for i in batches for idx in i]
+        pattern = self.get_sparsity_pattern(cell_indices, n_dofs)
+
+        def calculate(batches):
+            return np.concatenate(
+                [
+                    self.get_element_matrices(
+                        CellBatch(self.mesh, indices, self.cell_dofs)
+                    ).ravel()
+                    for indices in batches
+                ]
+            )
+
+        sizes = [
+            sum([len(self.cell_dofs[idx]) ** 2 for i in batches for idx in i])
+            for batches in partitions
+        ]
+        values = run_in_processes(calculate, partitions, sizes, n_workers)
+
+        return pattern.create_matrix(values)
+
+    def get_sparsity_pattern(self, cell_indices, n_dofs):
+        pattern = getattr(self, "sparsity_pattern", None)
+
+        if pattern is None or not pattern.matches(cell_indices, n_dofs):
+            pattern = SparsityPattern(
+                cell_indices, [self.cell_dofs[idx] for idx in cell_indices], n_dofs
+            )
+            self.sparsity_pattern = pattern
+
+        return pattern
+
+    def assemble_dense(self, n_dofs, result=None):
+        if result is None:
+            result = np.zeros((n_dofs, n_dofs))
+
+        for batch in self.get_cell_batches():
+            elem_matrices = self.get_element_matrices(batch)
+
+            for dofmap, elem_matrix in zip(batch.dofs, elem_matrices):
+                result[np.ix_(dofmap, dofmap)] += elem_matrix
 
         return result
 
@@ -70,27 +367,72 @@ class VectorAssembler(Assembler):
     def calculate_element_vector(self, cell):
         raise Exception("Do not use base class")
 
+    def calculate_element_vectors(self, batch):
+        "Returns an array with shape (n_cell, n_dof, 1)"
+        return np.array([self.calculate_element_vector(cell) for cell in batch.cells])
+
+    def get_element_vectors(self, batch):
+        if self.has_batched_kernel(
+            "calculate_element_vector", "calculate_element_vectors"
+        ):
+            return self.calculate_element_vectors(batch)
+        else:
+            return VectorAssembler.calculate_element_vectors(self, batch)
+
     def assemble(self):
         n_dofs = len(self.mesh.nodes) * self.function_size
-        result = np.zeros((n_dofs, 1))
+
+        return self.assemble_into(np.zeros((n_dofs, 1)))
+
+    def assemble_into(self, result):
+        "Adds the assembled vector to result, which has shape (n_dofs, 1)"
+        n_dofs = len(result)
 
         logging.debug("Beginning to assemble vector")
         start_time = time.time()
 
-        for idx, cell in enumerate(self.mesh.cells):
-            if not self.domain.is_subset(cell):
-                continue
+        backend, n_workers = get_assembly_backend()
 
-            elem_vector = self.calculate_element_vector(cell)
-            # print(elem_vector)
-            dofmap = self.cell_dofs[idx]
+        if backend == "threads":
+            # Cells of a color share no dofs, so their entries are distinct
+            def scatter(batch):
+                elem_vectors = self.get_element_vectors(batch)
+                result[batch.dofs.ravel(), 0] += elem_vectors.ravel()
 
-            result[dofmap] += elem_vector
+            run_colored(self.get_colored_batches(n_workers), scatter, n_workers)
+        elif backend == "processes":
+            result[:, 0] += self.assemble_processes(n_dofs, n_workers)
+        else:
+            for batch in self.get_cell_batches():
+                elem_vectors = self.get_element_vectors(batch)
 
-            # for i, I in enumerate(dofmap):
-            # result[I] += elem_vector[i]
+                result[:, 0] += np.bincount(
+                    batch.dofs.ravel(), weights=elem_vectors.ravel(), minlength=n_dofs
+                )
 
-        # import ipdb; ipdb.set_trace()
         logging.debug("Vector assembled in %f sec" % (time.time() - start_time))
 
         return result
+
+    def assemble_processes(self, n_dofs, n_workers):
+        partitions = self.get_partitioned_batches(n_workers)
+        cell_indices = [idx for batches in partitions for i in batches for idx in i]
+
+        def calculate(batches):
+            return np.concatenate(
+                [
+                    self.get_element_vectors(
+                        CellBatch(self.mesh, indices, self.cell_dofs)
+                    ).ravel()
+                    for indices in batches
+                ]
+            )
+
+        sizes = [
+            sum([len(self.cell_dofs[idx]) for i in batches for idx in i])
+            for batches in partitions
+        ]
+        values = run_in_processes(calculate, partitions, sizes, n_workers)
+        dofs = np.concatenate([self.cell_dofs[idx] for idx in cell_indices])
+
+        return np.bincount(dofs, weights=values, minlength=n_dofs)
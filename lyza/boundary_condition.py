@@ -1,3 +1,7 @@
+import numpy as np
+import weakref
+
+
 def join_boundaries(boundaries):
     def result(x, t):
         test = [b(x, t) for b in boundaries]
@@ -7,14 +11,74 @@ def join_boundaries(boundaries):
 
 
 class DirichletBC:
-    def __init__(self, function, position_bool, components=None):
+    """If vectorized is true, position_bool and function are called with the
+    (n_node, 3) coordinate array. position_bool then returns a boolean array
+    with shape (n_node,), and function an array with shape (n_node, n_value)
+    or the n_value constant values. Otherwise they are called per node"""
+
+    def __init__(self, function, position_bool, components=None, vectorized=False):
         self.function = function
         self.position_bool = position_bool
         self.components = components
+        self.vectorized = vectorized
         self.time = 0
 
+        # Constrained nodes and values per mesh, which do not keep meshes alive
+        self.node_cache = weakref.WeakKeyDictionary()
+        self.value_cache = weakref.WeakKeyDictionary()
+
     def set_time(self, t):
+        if t != self.time:
+            self.value_cache.clear()
+
         self.time = t
 
     def value(self, coor):
         return self.function(coor, self.time)
+
+    def get_node_indices(self, mesh):
+        "Returns the indices of the constrained nodes, which are selected once"
+        entry = self.node_cache.get(mesh)
+
+        if entry is None or entry[0] != len(mesh.nodes):
+            if self.vectorized:
+                mask = np.asarray(self.position_bool(mesh.coordinates, 0), dtype=bool)
+                indices = np.flatnonzero(mask.reshape(-1))
+            else:
+                indices = np.array(
+                    [n.idx for n in mesh.nodes if self.position_bool(n.coor, 0)],
+                    dtype=np.int64,
+                )
+
+            entry = (len(mesh.nodes), indices)
+            self.node_cache[mesh] = entry
+
+        return entry[1]
+
+    def get_values(self, mesh, components):
+        """Returns the values of the components at the constrained nodes with
+        shape (n_node, n_component). Values of vectorized conditions are
+        evaluated once per time"""
+        node_indices = self.get_node_indices(mesh)
+
+        if not self.vectorized:
+            result = np.zeros((len(node_indices), len(components)))
+            for i, idx in enumerate(node_indices):
+                value = self.value(mesh.nodes[idx].coor)
+                for j, component in enumerate(components):
+                    result[i, j] = np.squeeze(value[component])
+
+            return result
+
+        values = self.value_cache.get(mesh)
+
+        if values is None or len(values) != len(node_indices):
+            values = np.asarray(
+                self.function(mesh.coordinates[node_indices], self.time), dtype=float
+            )
+            if values.ndim == 1:
+                values = np.broadcast_to(values, (len(node_indices), len(values)))
+
+            self.value_cache[mesh] = values
+
+        return values[:, components]
@@ -1,92 +1,78 @@
 from math import sqrt, cos, sin, pi
 import numpy as np
 import itertools
-from lyza.helper import determinant, inverse
 
+# Reference values keyed by (cell class, quadrature degree)
+REFERENCE_VALUES = {}
 
-class Cell:
-    N = []
-    Bhat = []
-    elem_dim = None
 
-    def __init__(self, nodes, is_boundary=False, label=None):
-        self.label = label
-        self.nodes = nodes
-        self.n_node = len(self.nodes)
-        self.is_boundary = is_boundary
+class ReferenceValues:
+    """Quadrature points and weights of a cell type together with the values of
+    the shape functions and their derivatives at the points, tabulated once"""
 
-    def all_nodes_in(self, position, t=0):
-        return not (False in [position(node.coor, t) for node in self.nodes])
-
-    def some_nodes_in(self, position):
-        return True in [position(node.coor) for node in self.nodes]
-
-    def get_quad_points(self, quadrature_degree):
-        raise Exception("Do not use the base class")
-
-    def calculate_basis_values(self, spatial_dim, quadrature_degree):
-        self.n_node = len(self.nodes)
+    def __init__(self, cell, quadrature_degree):
+        self.quad_weights, self.quad_coors = cell.get_quad_points(quadrature_degree)
 
-        quad_weights, quad_coors = self.get_quad_points(quadrature_degree)
-
-        for i in quad_coors:
+        for i in self.quad_coors:
             if i.shape != (3, 1):
                 raise Exception(
                     "Invalid shape for quadrature point coordinates. Fix your element code."
                 )
 
-        N_arr = []
-        B_arr = []
-        jac_arr = []
-        det_jac_arr = []
-        jac_inv_tra_arr = []
-        global_coor_arr = []
-
-        for coor in quad_coors:
-            jac = self.jacobian(coor, spatial_dim)
-            det_jac = determinant(jac)
-            jac_inv_tra = inverse(jac).transpose()
-
-            jac_arr.append(jac)
-            det_jac_arr.append(np.array(det_jac).reshape(1, 1))
-            jac_inv_tra_arr.append(jac_inv_tra)
+        self.n_point = len(self.quad_coors)
+        self.n_node = len(cell.N)
 
-            N = np.zeros((self.n_node, 1))
-            B = np.zeros((self.n_node, spatial_dim))
+        # Arrays with shape (n_point,), (n_point, 3), (n_point, n_node) and
+        # (n_point, n_node, elem_dim)
+        self.weights = np.array([np.ravel(i)[0] for i in self.quad_weights])
+        self.points = np.array([i[:, 0] for i in self.quad_coors]).reshape(-1, 3)
+        self.N = np.zeros((self.n_point, self.n_node))
+        self.dN = np.zeros((self.n_point, self.n_node, cell.elem_dim))
 
-            for I in range(len(self.N)):
-                N[I] = self.N[I](coor)
-                B[I] = jac_inv_tra.dot(self.Bhat[I](coor)).T
+        for point_idx, coor in enumerate(self.quad_coors):
+            for I in range(self.n_node):
+                self.N[point_idx, I] = np.ravel(cell.N[I](coor))[0]
+                self.dN[point_idx, I] = np.ravel(cell.Bhat[I](coor))
 
-            N_arr.append(N)
-            B_arr.append(B)
+        self.stiffness_tensor = None
 
-            quad_point_global = [0.0, 0.0, 0.0]
+    def get_stiffness_tensor(self):
+        """Returns sum_q w_q dN_qia dN_qjb with shape (n_node, elem_dim, n_node,
+        elem_dim). Contracting it with the inverse Jacobian of an affine cell
+        gives the integral of B B^T without looping over the points"""
+        if self.stiffness_tensor is None:
+            self.stiffness_tensor = np.einsum(
+                "q,qia,qjb->iajb", self.weights, self.dN, self.dN
+            )
 
-            coor_matrix = np.zeros((self.n_node, 3))
-            for idx, n in enumerate(self.nodes):
-                coor_matrix[idx] = n.coor.T
+        return self.stiffness_tensor
 
-            quad_point_global = coor_matrix.T.dot(N)
 
-            # for I in itertools.product(range(self.n_node)):
-            #     quad_point_global[i] += N[I]*self.nodes[I].coor[i]
+class Cell:
+    N = []
+    Bhat = []
+    elem_dim = None
 
-            global_coor_arr.append(np.array(quad_point_global))
+    def __init__(self, nodes, is_boundary=False, label=None):
+        self.label = label
+        self.nodes = nodes
+        self.n_node = len(self.nodes)
+        self.is_boundary = is_boundary
 
-        return N_arr, B_arr, jac_arr, det_jac_arr, jac_inv_tra_arr, global_coor_arr
+    def all_nodes_in(self, position, t=0):
+        return not (False in [position(node.coor, t) for node in self.nodes])
 
-    def jacobian(self, xi, spatial_dim):
-        J = np.zeros((spatial_dim, self.elem_dim))
+    def some_nodes_in(self, position):
+        return True in [position(node.coor) for node in self.nodes]
 
-        for I in range(len(self.nodes)):
-            Bhat = self.Bhat[I](xi)
-            coor = self.nodes[I].coor[:spatial_dim]
+    def get_quad_points(self, quadrature_degree):
+        raise Exception("Do not use the base class")
 
-            J += coor * Bhat.T
+    def get_reference_values(self, quadrature_degree):
+        "Returns the cached reference values for the cell type and degree"
+        key = (type(self), quadrature_degree)
 
-            # for i in range(spatial_dim):
-            #     for j in range(self.elem_dim):
-            #         J[i,j] += coor[i]*Bhat[j]
+        if key not in REFERENCE_VALUES:
+            REFERENCE_VALUES[key] = ReferenceValues(self, quadrature_degree)
 
-        return J
+        return REFERENCE_VALUES[key]
@@ -0,0 +1,84 @@
+import numpy as np
+
+
+class CellBatch:
+    def __init__(self, mesh, cell_indices, cell_dofs):
+        self.mesh = mesh
+        self.cell_indices = np.array(cell_indices, dtype=np.int64)
+        self.cells = [mesh.cells[idx] for idx in self.cell_indices]
+        self.cell_type = type(self.cells[0])
+
+        self.n_cell = len(self.cells)
+        self.n_node = len(self.cells[0].nodes)
+        self.node_indices = mesh.get_cell_node_indices(self.cell_indices)
+        self.dofs = np.array(
+            [cell_dofs[idx] for idx in self.cell_indices], dtype=np.int64
+        ).reshape(self.n_cell, -1)
+
+        # Cells with constant Jacobians can use the reference tables directly
+        degrees = getattr(mesh, "quadrature_degrees", None)
+        affine_cells = getattr(mesh, "affine_cells", None)
+
+        if degrees is not None:
+            batch_degrees = degrees[self.cell_indices]
+        else:
+            batch_degrees = np.array([-1])
+
+        if batch_degrees[0] >= 0 and np.all(batch_degrees == batch_degrees[0]):
+            self.quadrature_degree = int(batch_degrees[0])
+            self.reference = self.cells[0].get_reference_values(batch_degrees[0])
+            self.is_affine = bool(np.all(affine_cells[self.cell_indices]))
+        else:
+            self.quadrature_degree = None
+            self.reference = None
+            self.is_affine = False
+
+    def __len__(self):
+        return self.n_cell
+
+    def get_quantity(self, key):
+        "Returns the stacked quantity with shape (n_cell, n_quad_point, ...)"
+        return self.mesh.quantities[key].get_quantity_batch(self.cell_indices)
+
+    def get_cell_quantity(self, key):
+        "Returns the quantity at the first point with shape (n_cell, ...)"
+        return self.get_quantity(key)[:, 0]
+
+    def get_weights(self):
+        "Returns the quadrature weights times the Jacobian determinants"
+        W = self.get_quantity("W")
+        DETJ = self.get_quantity("DETJ")
+        return W[:, :, 0, 0] * DETJ[:, :, 0, 0]
+
+
+def get_group_keys(mesh, cell_indices, cell_dof_counts):
+    """Returns an array with a row for every cell, which is the same for cells
+    with the same type, number of dofs and quadrature points"""
+    cell_indices = np.asarray(cell_indices, dtype=np.int64)
+    quantities = getattr(mesh, "quantities", {})
+    degrees = getattr(mesh, "quadrature_degrees", None)
+    affine_cells = getattr(mesh, "affine_cells", None)
+
+    columns = [mesh.cell_type_codes[cell_indices], cell_dof_counts[cell_indices]]
+    if "W" in quantities:
+        columns.append(quantities["W"].n_points[cell_indices])
+    if degrees is not None:
+        columns += [degrees[cell_indices], affine_cells[cell_indices]]
+
+    return np.stack(columns, axis=1).astype(np.int64)
+
+
+def group_cells(mesh, cell_indices, cell_dofs, keys):
+    """Groups cells with the same keys. The groups are in the order of their
+    first cell and keep the order of the cells"""
+    cell_indices = np.asarray(cell_indices, dtype=np.int64)
+    if len(cell_indices) == 0:
+        return []
+
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    order = np.argsort(inverse, kind="stable")
+    groups = np.split(cell_indices[order], np.cumsum(np.bincount(inverse))[:-1])
+
+    return [CellBatch(mesh, groups[i], cell_dofs) for i in np.argsort(first)]
@@ -2,6 +2,7 @@ import numpy as np
 import logging
 import time
 from lyza.domain import DefaultDomain
+from lyza.cell_batch import group_cells, get_group_keys
 
 flatten = lambda l: [item for sublist in l for item in sublist]
 
@@ -38,6 +39,10 @@ class CellIterator:
 
             self.cell_dofs.append(dofmap)
 
+        self.cell_dof_counts = np.array(
+            [len(i) for i in self.cell_dofs], dtype=np.int64
+        )
+
     def set_param(self, param_dict):
         for key, value in param_dict.items():
             self.param[key] = value
@@ -45,18 +50,61 @@ class CellIterator:
     def set_time(self, time):
         self.time = time
 
+    def get_cell_indices(self):
+        return self.domain.get_cell_indices(self.mesh)
+
+    def get_cell_batches(self, cell_indices=None):
+        if cell_indices is not None:
+            keys = get_group_keys(self.mesh, cell_indices, self.cell_dof_counts)
+            return group_cells(self.mesh, cell_indices, self.cell_dofs, keys)
+
+        # The batches of the domain are kept while its cells and their keys,
+        # which change with the quadrature degrees, stay the same
+        cell_indices = self.get_cell_indices()
+        keys = get_group_keys(self.mesh, cell_indices, self.cell_dof_counts)
+        cached = getattr(self, "cell_batches", None)
+
+        if (
+            cached is None
+            or not np.array_equal(cached[0], cell_indices)
+            or not np.array_equal(cached[1], keys)
+        ):
+            batches = group_cells(self.mesh, cell_indices, self.cell_dofs, keys)
+            cached = (cell_indices, keys, batches)
+            self.cell_batches = cached
+
+        return cached[2]
+
+    def has_batched_kernel(self, kernel_name, batched_kernel_name):
+        """Checks whether the batched kernel is implemented at least as far down
+        the class hierarchy as the per-cell kernel, so that subclasses which
+        only override the per-cell kernel keep using it"""
+        defining_classes = {}
+        for cls in reversed(type(self).__mro__):
+            for name in [kernel_name, batched_kernel_name]:
+                if name in cls.__dict__:
+                    defining_classes[name] = cls
+
+        return issubclass(
+            defining_classes[batched_kernel_name], defining_classes[kernel_name]
+        )
+
     def execute(self):
         logging.debug("Beginning to assemble matrix")
         start_time = time.time()
 
-        for idx, cell in enumerate(self.mesh.cells):
-            if not self.domain.is_subset(cell):
-                continue
-
-            self.iterate(cell)
-            dofmap = self.cell_dofs[idx]
+        if self.has_batched_kernel("iterate", "iterate_batch"):
+            for batch in self.get_cell_batches():
+                self.iterate_batch(batch)
+        else:
+            for idx in self.get_cell_indices():
+                self.iterate(self.mesh.cells[idx])
 
         logging.debug("Cell iterator finished in %f sec" % (time.time() - start_time))
 
     def iterate(self, cell):
         raise Exception("Do not use base class")
+
+    def iterate_batch(self, batch):
+        for cell in batch.cells:
+            self.iterate(cell)
@@ -3,133 +3,393 @@ import logging
 from lyza.function import Function
 
 
+class QuantityBlock:
+    "Contiguous storage for the values of all cells with the same array shape"
+
+    constant = False
+
+    def __init__(self, shape, n_rows, n_points):
+        self.shape = shape
+        self.array = np.zeros((n_rows, n_points) + shape)
+        self.n_rows = 0
+
+    def add_row(self):
+        if self.n_rows == self.array.shape[0]:
+            self.resize(max(1, 2 * self.n_rows), self.array.shape[1])
+
+        self.n_rows += 1
+        return self.n_rows - 1
+
+    def add_rows(self, n_rows):
+        if self.n_rows + n_rows > self.array.shape[0]:
+            self.resize(max(self.n_rows + n_rows, 2 * self.n_rows), self.array.shape[1])
+
+        self.n_rows += n_rows
+        return np.arange(self.n_rows - n_rows, self.n_rows)
+
+    def reserve_points(self, n_points):
+        if n_points > self.array.shape[1]:
+            self.resize(self.array.shape[0], max(n_points, 2 * self.array.shape[1]))
+
+    def resize(self, n_rows, n_points):
+        array = np.zeros((n_rows, n_points) + self.shape)
+        old_rows, old_points = self.array.shape[:2]
+        array[:old_rows, :old_points] = self.array
+        self.array = array
+
+    def copy(self):
+        result = QuantityBlock(self.shape, 0, 0)
+        result.array = self.array.copy()
+        result.n_rows = self.n_rows
+        return result
+
+
+class ConstantQuantityBlock(QuantityBlock):
+    """Storage for arrays that are the same at every point of a cell, such as
+    the Jacobian of an affine cell. The values are stored once per cell and
+    broadcast over the points when read"""
+
+    constant = True
+
+    def __init__(self, shape, n_rows, n_points):
+        self.shape = shape
+        self.values = np.zeros((n_rows,) + shape)
+        self.n_point_capacity = n_points
+        self.n_rows = 0
+
+    @property
+    def array(self):
+        return np.broadcast_to(
+            self.values[:, None],
+            (self.values.shape[0], self.n_point_capacity) + self.shape,
+        )
+
+    def reserve_points(self, n_points):
+        self.n_point_capacity = max(self.n_point_capacity, n_points)
+
+    def resize(self, n_rows, n_points):
+        values = np.zeros((n_rows,) + self.shape)
+        values[: self.values.shape[0]] = self.values
+        self.values = values
+        self.reserve_points(n_points)
+
+    def materialize(self):
+        "Returns a regular block with the same values, which can be written to"
+        result = QuantityBlock(self.shape, 0, 0)
+        result.array = np.array(self.array)
+        result.n_rows = self.n_rows
+        return result
+
+    def copy(self):
+        result = ConstantQuantityBlock(self.shape, 0, self.n_point_capacity)
+        result.values = self.values.copy()
+        result.n_rows = self.n_rows
+        return result
+
+
 class CellQuantity:
+    """Stores an array for every quadrature point of every cell. Arrays of the
+    same shape are kept in a single (n_cell, n_point, *shape) block, and the
+    per-cell accessors return views into it."""
+
     def __init__(self, mesh, shape):
         self.mesh = mesh
-        self.shape = shape
-
-        self.quantity_array_list = []
-        self.quantity_array_dict = {}
+        self.shape = tuple(shape) if shape else None
 
-        for cell in mesh.cells:
-            array = []
-            # for i in range(n_quantity_map(cell)):
-            #     array.append(np.zeros(shape))
+        n_cells = len(mesh.cells)
 
-            self.quantity_array_list.append(array)
-            self.quantity_array_dict[cell] = array
+        self.blocks = []
+        self.cell_block = np.full(n_cells, -1, dtype=np.int64)
+        self.cell_row = np.full(n_cells, -1, dtype=np.int64)
+        self.n_points = np.zeros(n_cells, dtype=np.int64)
 
-    def add_quantity_by_cell_idx(self, cell_idx, quantity_matrix):
         if self.shape:
-            if quantity_matrix.shape != self.shape:
+            # All cells share a single block whose rows are the cell indices
+            block = QuantityBlock(self.shape, n_cells, self._guess_n_points())
+            block.n_rows = n_cells
+            self.blocks.append(block)
+            self.cell_block[:] = 0
+            self.cell_row[:] = np.arange(n_cells)
+
+    def _guess_n_points(self):
+        quantities = getattr(self.mesh, "quantities", {})
+        if "W" in quantities and len(quantities["W"].n_points) > 0:
+            return int(quantities["W"].n_points.max())
+        else:
+            return 0
+
+    def _check_shape(self, shape):
+        if self.shape:
+            if shape != self.shape:
                 raise Exception(
                     "Array shape %s does not match quantity shape %s"
-                    % (quantity_matrix.shape, self.shape)
+                    % (shape, self.shape)
                 )
 
-        self.quantity_array_list[cell_idx].append(quantity_matrix)
+    def _get_block(self, cell_idx, shape):
+        block_idx = self.cell_block[cell_idx]
 
-    def add_quantity_by_cell(self, cell, quantity_matrix):
-        if self.shape:
-            if quantity_matrix.shape != self.shape:
-                raise Exception(
-                    "Array shape %s does not match quantity shape %s"
-                    % (quantity_matrix.shape, self.shape)
-                )
+        if block_idx >= 0 and self.blocks[block_idx].shape == shape:
+            if self.blocks[block_idx].constant:
+                self.blocks[block_idx] = self.blocks[block_idx].materialize()
+            return self.blocks[block_idx]
+
+        if self.n_points[cell_idx] > 0:
+            raise Exception(
+                "Array shape %s does not match the other arrays of the cell" % (shape,)
+            )
 
-        self.quantity_array_dict[cell].append(quantity_matrix)
+        block_idx = self._find_block(shape)
+        block = self.blocks[block_idx]
+
+        self.cell_block[cell_idx] = block_idx
+        self.cell_row[cell_idx] = block.add_row()
+
+        return block
+
+    def _find_block(self, shape, constant=False):
+        "Returns the index of the block with the given shape, creating it if needed"
+        for block_idx, block in enumerate(self.blocks):
+            if block.shape == shape and block.constant == constant:
+                return block_idx
+
+        if constant:
+            self.blocks.append(ConstantQuantityBlock(shape, 0, 0))
+        else:
+            self.blocks.append(QuantityBlock(shape, 0, self._guess_n_points()))
+
+        return len(self.blocks) - 1
+
+    def _move_cells(self, cell_indices, block_idx):
+        "Assigns new rows in the block to the cells that are not already in it"
+        new_cells = cell_indices[self.cell_block[cell_indices] != block_idx]
+
+        if len(new_cells) > 0:
+            self.cell_row[new_cells] = self.blocks[block_idx].add_rows(len(new_cells))
+            self.cell_block[new_cells] = block_idx
+
+    def add_quantity_by_cell_idx(self, cell_idx, quantity_matrix):
+        quantity_matrix = np.asarray(quantity_matrix)
+        self._check_shape(quantity_matrix.shape)
+
+        block = self._get_block(cell_idx, quantity_matrix.shape)
+        point_idx = self.n_points[cell_idx]
+        block.reserve_points(point_idx + 1)
+
+        block.array[self.cell_row[cell_idx], point_idx] = quantity_matrix
+        self.n_points[cell_idx] += 1
+
+    def add_quantity_by_cell(self, cell, quantity_matrix):
+        self.add_quantity_by_cell_idx(cell.idx, quantity_matrix)
 
     def add_zero_array(self, cell, n_array=1):
         for i in range(n_array):
-            self.quantity_array_dict[cell].append(np.zeros(self.shape))
+            self.add_quantity_by_cell_idx(cell.idx, np.zeros(self.shape))
 
     def reset_quantity_by_cell(self, cell):
-        # self.quantity_array_dict[cell] = []
-        del self.quantity_array_dict[cell][:]
+        self.n_points[cell.idx] = 0
 
     def get_quantity(self, cell):
-        return self.quantity_array_dict[cell]
+        return self.get_quantity_by_idx(cell.idx)
 
     def get_quantity_by_idx(self, cell_idx):
-        return self.quantity_array_list[cell_idx]
+        block_idx = self.cell_block[cell_idx]
 
-    def get_function(self):
-        # if function_space == 1:
-        #     target_space = self.function_space_1
-        # elif function_space == 2:
-        #     target_space = self.function_space_2
-        # else:
-        #     raise Exception('Function space can be either 1 or 2')
+        if block_idx < 0:
+            return []
 
-        if self.shape[1] > 1:
-            raise Exception("Projecting matrix quantities not yet implemented")
+        block = self.blocks[block_idx]
+        return block.array[self.cell_row[cell_idx], : self.n_points[cell_idx]]
 
-        function_size = self.shape[0]
+    def get_quantity_batch(self, cell_indices):
+        "Returns the arrays of the cells stacked with shape (n_cell, n_point, ...)"
+        cell_indices = np.asarray(cell_indices, dtype=np.int64)
+        block_indices = self.cell_block[cell_indices]
+        n_points = self.n_points[cell_indices]
 
-        result = Function(self.mesh, function_size)
+        if len(cell_indices) == 0:
+            return np.zeros((0, 0) + (self.shape or ()))
 
-        n_dof = len(self.mesh.nodes) * function_size
-        f = np.zeros((n_dof, 1))
-        w = np.zeros((n_dof, 1))
+        if np.any(block_indices != block_indices[0]) or np.any(n_points != n_points[0]):
+            raise Exception("Cells in a batch need to have arrays of the same shape")
 
-        for cell in self.mesh.cells:
-            # target_elem = interface.elements[function_space-1]
+        if block_indices[0] < 0:
+            return np.zeros((len(cell_indices), 0) + (self.shape or ()))
 
-            # target_quantity = quantity_map(interface)
+        block = self.blocks[block_indices[0]]
+        rows = self.cell_row[cell_indices]
 
-            for node_i, node in enumerate(cell.nodes):
-                f_elem = self._projection_vector(cell, node_i)
-                w_elem = self._projection_weight_vector(cell, node_i)
-                dofs = result.node_dofs[node.idx]
+        if rows[-1] - rows[0] == len(rows) - 1 and np.all(np.diff(rows) == 1):
+            return block.array[rows[0] : rows[-1] + 1, : n_points[0]]
+        else:
+            return block.array[rows, : n_points[0]]
 
-                for dof_i, dof in enumerate(dofs):
-                    f[dof] += f_elem[dof_i]
-                    w[dof] += w_elem[dof_i]
+    def set_quantity_batch(self, cell_indices, arrays):
+        "Sets the arrays of the cells from an array with shape (n_cell, n_point, ...)"
+        cell_indices = np.asarray(cell_indices, dtype=np.int64)
+        arrays = np.asarray(arrays)
+        shape = arrays.shape[2:]
+        self._check_shape(shape)
 
-        projected_values = f / w
-        result.set_vector(projected_values)
+        # Cells without arrays of this shape get new rows, their old values are
+        # discarded
+        block_idx = self._find_block(shape)
+        self._move_cells(cell_indices, block_idx)
 
-        return result
+        block = self.blocks[block_idx]
+        block.reserve_points(arrays.shape[1])
+
+        block.array[self.cell_row[cell_indices], : arrays.shape[1]] = arrays
+        self.n_points[cell_indices] = arrays.shape[1]
+
+    def set_constant_batch(self, cell_indices, arrays, n_points):
+        """Sets a single array with shape (n_cell, ...) for all n_points points of
+        each cell, which is stored only once"""
+        cell_indices = np.asarray(cell_indices, dtype=np.int64)
+        arrays = np.asarray(arrays)
+        shape = arrays.shape[1:]
+        self._check_shape(shape)
 
-    def _projection_vector(self, cell, node_idx):
-        n_dof = self.shape[0]
-        f = np.zeros((n_dof, 1))
+        block_idx = self._find_block(shape, constant=True)
+        self._move_cells(cell_indices, block_idx)
 
-        N_arr = self.mesh.quantities["N"].get_quantity(cell)
-        DETJ_arr = self.mesh.quantities["DETJ"].get_quantity(cell)
-        W_arr = self.mesh.quantities["W"].get_quantity(cell)
-        arrays = self.get_quantity(cell)
+        block = self.blocks[block_idx]
+        block.reserve_points(n_points)
 
-        for idx in range(len(W_arr)):
-            DETJ = DETJ_arr[idx][0, 0]
-            W = W_arr[idx][0, 0]
-            N = N_arr[idx]
-            for i in range(n_dof):
-                f[i] += arrays[idx][i, 0] * N[node_idx, 0] * DETJ * W
+        block.values[self.cell_row[cell_indices]] = arrays
+        self.n_points[cell_indices] = n_points
 
-        return f
+    def get_function(self, consistent=False):
+        """Projects the quantity to the nodes. By default, the nodal values are
+        averages weighted with the shape functions, which is the projection
+        with the lumped mass matrix. With consistent, the projection is solved
+        with the full mass matrix, whose factorization is kept on the mesh"""
+        if self.shape[1] > 1:
+            raise Exception("Projecting matrix quantities not yet implemented")
+
+        function_size = self.shape[0]
+        n_node = len(self.mesh.nodes)
+
+        result = Function(self.mesh, function_size)
 
-    def _projection_weight_vector(self, cell, node_idx):
-        n_dof = self.shape[0]
-        f = np.zeros((n_dof, 1))
+        f = np.zeros((n_node, function_size))
+        w = np.zeros(n_node)
 
-        N_arr = self.mesh.quantities["N"].get_quantity(cell)
-        DETJ_arr = self.mesh.quantities["DETJ"].get_quantity(cell)
-        W_arr = self.mesh.quantities["W"].get_quantity(cell)
+        groups = self._get_projection_groups()
 
-        for idx in range(len(W_arr)):
-            DETJ = DETJ_arr[idx][0, 0]
-            W = W_arr[idx][0, 0]
-            N = N_arr[idx]
-            for i in range(n_dof):
-                f[i] += N[node_idx, 0] * DETJ * W
+        for cell_indices in groups:
+            node_indices = self.mesh.get_cell_node_indices(cell_indices)
+            N, WDETJ = self._get_projection_weights(cell_indices)
+            values = self.get_quantity_batch(cell_indices)[:, :, :, 0]
 
-        return f
+            f_elem = np.einsum("cqd, cqn, cq -> cnd", values, N, WDETJ)
+            w_elem = np.einsum("cqn, cq -> cn", N, WDETJ)
+
+            for i in range(function_size):
+                f[:, i] += np.bincount(
+                    node_indices.ravel(),
+                    weights=f_elem[:, :, i].ravel(),
+                    minlength=n_node,
+                )
+            w += np.bincount(
+                node_indices.ravel(), weights=w_elem.ravel(), minlength=n_node
+            )
+
+        if consistent:
+            solve = self._get_mass_matrix_solver(groups)
+            projected_values = np.array(
+                [solve(f[:, i]) for i in range(function_size)]
+            ).T
+        else:
+            projected_values = f / w[:, None]
+
+        result.set_vector(projected_values.reshape(-1, 1))
+
+        return result
+
+    def _get_projection_groups(self):
+        "Groups the cells with values whose arrays can be read as batches"
+        cell_indices = np.flatnonzero(self.n_points > 0)
+        quantities = [self] + [self.mesh.quantities[i] for i in ["N", "W", "DETJ"]]
+        type_indices = np.array(
+            [id(type(self.mesh.cells[idx])) for idx in cell_indices], dtype=np.int64
+        )
+
+        keys = np.stack(
+            [type_indices, self.n_points[cell_indices]]
+            + [q.cell_block[cell_indices] for q in quantities],
+            axis=1,
+        )
+        if len(keys) == 0:
+            return []
+
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        return [cell_indices[inverse == i] for i in range(len(unique_keys))]
+
+    def _get_projection_weights(self, cell_indices):
+        "Returns the shape functions and the integration weights at the points"
+        n_point = self.n_points[cell_indices[0]]
+        N = self.mesh.quantities["N"].get_quantity_batch(cell_indices)[:, :n_point]
+        W = self.mesh.quantities["W"].get_quantity_batch(cell_indices)[:, :n_point]
+        DETJ = self.mesh.quantities["DETJ"].get_quantity_batch(cell_indices)
+        return N[:, :, :, 0], W[:, :, 0, 0] * DETJ[:, :n_point, 0, 0]
+
+    def _get_mass_matrix_solver(self, groups):
+        "Returns the factorized scalar mass matrix of the cells in groups"
+        cell_indices = np.sort(np.concatenate(groups))
+        basis = [self.mesh.quantities[i] for i in ["N", "W", "DETJ"]]
+
+        cached = getattr(self.mesh, "projection_solver", None)
+        if (
+            cached is not None
+            and all([i is j for i, j in zip(cached[0], basis)])
+            and np.array_equal(cached[1], cell_indices)
+        ):
+            return cached[2]
+
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.linalg import factorized
+
+        n_node = len(self.mesh.nodes)
+        rows, cols, values = [], [], []
+
+        for indices in groups:
+            node_indices = self.mesh.get_cell_node_indices(indices)
+            N, WDETJ = self._get_projection_weights(indices)
+            n = node_indices.shape[1]
+
+            rows.append(np.repeat(node_indices, n, axis=1).ravel())
+            cols.append(np.tile(node_indices, (1, n)).ravel())
+            values.append(np.einsum("cqi, cqj, cq -> cij", N, N, WDETJ).ravel())
+
+        M = coo_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(n_node, n_node),
+        ).tocsc()
+
+        # Nodes without cells get zero values
+        unused = np.flatnonzero(M.diagonal() == 0)
+        if len(unused) > 0:
+            M = (
+                M
+                + coo_matrix(
+                    (np.ones(len(unused)), (unused, unused)), shape=(n_node, n_node)
+                ).tocsc()
+            )
+
+        solve = factorized(M)
+        self.mesh.projection_solver = (basis, cell_indices, solve)
+
+        return solve
 
     def copy(self):
         result = CellQuantity(self.mesh, self.shape)
 
-        for cell in self.mesh.cells:
-            del result.quantity_array_dict[cell][:]
-            result.quantity_array_dict[cell].extend(self.quantity_array_dict[cell])
+        result.blocks = [block.copy() for block in self.blocks]
+        result.cell_block = self.cell_block.copy()
+        result.cell_row = self.cell_row.copy()
+        result.n_points = self.n_points.copy()
+
         return result
@@ -1,7 +1,50 @@
+import numpy as np
+import weakref
+
+
 class Domain:
     def is_subset(self, cell, is_boundary):
         raise Exception("Do not use the base class")
 
+    def get_cell_indices(self, mesh):
+        """Returns the sorted indices of the cells of mesh in the domain. They
+        are computed once per mesh, call invalidate after changing the mesh"""
+        cache = self.__dict__.get("_cell_indices")
+        if cache is None:
+            cache = weakref.WeakKeyDictionary()
+            self._cell_indices = cache
+
+        entry = cache.get(mesh)
+
+        # Adding cells to the mesh changes the indices
+        if entry is None or entry[0] != len(mesh.cells):
+            indices = np.array(
+                [idx for idx, cell in enumerate(mesh.cells) if self.is_subset(cell)],
+                dtype=np.int64,
+            )
+            indices.flags.writeable = False
+            entry = (len(mesh.cells), indices)
+            cache[mesh] = entry
+
+        return entry[1]
+
+    def get_cell_mask(self, mesh):
+        "Returns a boolean array that is true for the cells in the domain"
+        result = np.zeros(len(mesh.cells), dtype=bool)
+        result[self.get_cell_indices(mesh)] = True
+        return result
+
+    def invalidate(self, mesh=None):
+        "Discards the cell indices of mesh, or of all meshes"
+        cache = self.__dict__.get("_cell_indices")
+        if cache is None:
+            return
+
+        if mesh is None:
+            cache.clear()
+        else:
+            cache.pop(mesh, None)
+
 
 class DefaultDomain(Domain):
     def is_subset(self, cell):
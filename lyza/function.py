@@ -1,3 +1,4 @@
+import copy
 import numpy as np
 
 
@@ -29,7 +30,8 @@ class Function:
         return self.vector[start_idx:end_idx]
 
     def copy(self):
-        result = Function(self.function_space)
+        "Copies the vector, the dof lists are shared"
+        result = copy.copy(self)
         result.vector = self.vector.copy()
         return result
 
@@ -15,3 +15,54 @@ def determinant(J):
         return np.linalg.det(J)
     else:
         return sqrt(np.linalg.det(J.transpose().dot(J)))
+
+
+def batch_determinant(J):
+    "Determinants of stacked matrices with shape (..., m, n)"
+    if J.shape[-2] != J.shape[-1]:
+        return np.sqrt(batch_determinant(np.swapaxes(J, -1, -2) @ J))
+
+    size = J.shape[-1]
+
+    if size == 1:
+        return J[..., 0, 0].copy()
+    elif size == 2:
+        return J[..., 0, 0] * J[..., 1, 1] - J[..., 0, 1] * J[..., 1, 0]
+    elif size == 3:
+        return (
+            J[..., 0, 0] * (J[..., 1, 1] * J[..., 2, 2] - J[..., 1, 2] * J[..., 2, 1])
+            - J[..., 0, 1] * (J[..., 1, 0] * J[..., 2, 2] - J[..., 1, 2] * J[..., 2, 0])
+            + J[..., 0, 2] * (J[..., 1, 0] * J[..., 2, 1] - J[..., 1, 1] * J[..., 2, 0])
+        )
+    else:
+        return np.linalg.det(J)
+
+
+def batch_inverse(J):
+    """Inverses of stacked matrices with shape (..., m, n). Non-square matrices
+    get the pseudo-inverse, as in inverse()"""
+    if J.shape[-2] != J.shape[-1]:
+        J_T = np.swapaxes(J, -1, -2)
+        return batch_inverse(J_T @ J) @ J_T
+
+    size = J.shape[-1]
+    det = batch_determinant(J)[..., None, None]
+
+    if size == 1:
+        return 1.0 / J
+    elif size == 2:
+        adjugate = np.empty(J.shape)
+        adjugate[..., 0, 0] = J[..., 1, 1]
+        adjugate[..., 0, 1] = -J[..., 0, 1]
+        adjugate[..., 1, 0] = -J[..., 1, 0]
+        adjugate[..., 1, 1] = J[..., 0, 0]
+        return adjugate / det
+    elif size == 3:
+        # The rows of the adjugate are cross products of the columns
+        adjugate = np.empty(J.shape)
+        for i in range(3):
+            j, k = (i + 1) % 3, (i + 2) % 3
+            adjugate[..., i, :] = np.cross(J[..., :, j], J[..., :, k])
+        return adjugate / det
+    else:
+        return np.linalg.inv(J)
@@ -6,11 +6,8 @@ class Integrator(CellIterator):
         n_dofs = len(self.mesh.nodes) * self.function_size
         result = 0.0
 
-        for idx, cell in enumerate(self.mesh.cells):
-            if not self.domain.is_subset(cell):
-                continue
-
-            elem_value = self.calculate_element_integral(cell)
+        for idx in self.get_cell_indices():
+            elem_value = self.calculate_element_integral(self.mesh.cells[idx])
             result += elem_value
 
         return result
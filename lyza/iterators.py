@@ -5,6 +5,12 @@ import numpy as np
 import itertools
 
 
+def get_node_values(function, batch):
+    "Returns the nodal values with shape (n_cell, n_node, function_size)"
+    values = function.vector[:, 0].reshape(-1, function.function_size)
+    return values[batch.node_indices]
+
+
 class Projector(CellIterator):
     def set_param(self, function, quantity_key):
         self.function = function
@@ -31,6 +37,14 @@ class Projector(CellIterator):
 
             self.mesh.quantities[self.quantity_key].add_quantity_by_cell(cell, result)
 
+    def iterate_batch(self, batch):
+        N = batch.get_quantity("N")[:, :, :, 0]
+        result = np.einsum("cqn, cni -> cqi", N, get_node_values(self.function, batch))
+
+        self.mesh.quantities[self.quantity_key].set_quantity_batch(
+            batch.cell_indices, result[:, :, :, None]
+        )
+
 
 class GradientProjector(CellIterator):
     def set_param(self, function, quantity_key, spatial_dimension):
@@ -60,6 +74,16 @@ class GradientProjector(CellIterator):
 
             self.mesh.quantities[self.quantity_key].add_quantity_by_cell(cell, result)
 
+    def calculate_gradients(self, batch):
+        "Returns the gradients with shape (n_cell, n_point, function_size, dim)"
+        B = batch.get_quantity("B")[:, :, :, : self.spatial_dimension]
+        return np.einsum("cqnj, cni -> cqij", B, get_node_values(self.function, batch))
+
+    def iterate_batch(self, batch):
+        self.mesh.quantities[self.quantity_key].set_quantity_batch(
+            batch.cell_indices, self.calculate_gradients(batch)
+        )
+
 
 class SymmetricGradientProjector(GradientProjector):
     def iterate(self, cell):
@@ -81,6 +105,13 @@ class SymmetricGradientProjector(GradientProjector):
             result = 0.5 * (result + result.T)
             self.mesh.quantities[self.quantity_key].add_quantity_by_cell(cell, result)
 
+    def iterate_batch(self, batch):
+        gradients = self.calculate_gradients(batch)
+
+        self.mesh.quantities[self.quantity_key].set_quantity_batch(
+            batch.cell_indices, 0.5 * (gradients + np.swapaxes(gradients, -1, -2))
+        )
+
 
 class LinearStressCalculator(ElasticityBase, CellIterator):
     def iterate(self, cell):
@@ -151,3 +182,47 @@ class VoigtConverter(CellIterator):
             self.mesh.quantities[self.target_quantity_key].add_quantity_by_cell(
                 cell, self.to_voigt(source)
             )
+
+
+class MaterialUpdater(CellIterator):
+    """Evaluates a MaterialModel at all quadrature points of the cells. The
+    history of the previous step is read from the quantities with the keys of
+    the history and the suffix N, such as EPSPN, and the updated history is
+    stored without the suffix"""
+
+    def set_param(self, material, stress_key="SIG", tangent_key="CTENSOR"):
+        self.material = material
+        self.stress_key = stress_key
+        self.tangent_key = tangent_key
+
+        self.mesh.quantities[stress_key] = CellQuantity(self.mesh, (3, 3))
+        self.mesh.quantities[tangent_key] = CellQuantity(self.mesh, (3, 3, 3, 3))
+
+        for key, shape in material.history.items():
+            self.mesh.quantities[key] = CellQuantity(self.mesh, shape)
+
+    def iterate_batch(self, batch):
+        strain = batch.get_quantity(self.material.strain_key)
+        n_cell, n_point = strain.shape[:2]
+
+        def stack(array):
+            return array.reshape((n_cell * n_point,) + array.shape[2:])
+
+        def unstack(array):
+            return array.reshape((n_cell, n_point) + array.shape[1:])
+
+        history = {
+            key: stack(batch.get_quantity(key + "N")) for key in self.material.history
+        }
+        stress, tangent, history = self.material.update(stack(strain), history)
+
+        self.mesh.quantities[self.stress_key].set_quantity_batch(
+            batch.cell_indices, unstack(stress)
+        )
+        self.mesh.quantities[self.tangent_key].set_quantity_batch(
+            batch.cell_indices, unstack(tangent)
+        )
+        for key, value in history.items():
+            self.mesh.quantities[key].set_quantity_batch(
+                batch.cell_indices, unstack(value)
+            )
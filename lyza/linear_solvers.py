@@ -0,0 +1,255 @@
+import numpy as np
+import logging
+import inspect
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse.linalg import (
+    LinearOperator,
+    spsolve,
+    splu,
+    spilu,
+    factorized,
+    cg,
+    gmres,
+    bicgstab,
+    minres,
+)
+
+LINEAR_SOLVERS = {}
+PRECONDITIONERS = {}
+
+
+def register_linear_solver(name):
+    "Decorator that makes a solver function selectable by name"
+
+    def decorator(function):
+        LINEAR_SOLVERS[name] = function
+        return function
+
+    return decorator
+
+
+def register_preconditioner(name):
+    "Decorator that makes a preconditioner selectable by name"
+
+    def decorator(function):
+        PRECONDITIONERS[name] = function
+        return function
+
+    return decorator
+
+
+class SolverInfo:
+    "Iteration count and residual history of a linear solve"
+
+    def __init__(self, solver):
+        self.solver = solver
+        self.iterations = 0
+        self.residuals = []
+        self.residual = None
+        self.converged = True
+
+    def __repr__(self):
+        return "SolverInfo(solver=%s, iterations=%d, residual=%s, converged=%s)" % (
+            self.solver,
+            self.iterations,
+            self.residual,
+            self.converged,
+        )
+
+
+def get_linear_solver(name):
+    if name not in LINEAR_SOLVERS:
+        raise Exception("Unknown solver: %s" % name)
+
+    return LINEAR_SOLVERS[name]
+
+
+def get_preconditioner(A, solver_parameters):
+    name = solver_parameters.get("preconditioner", None)
+
+    if name is None:
+        return None
+    elif name not in PRECONDITIONERS:
+        raise Exception("Unknown preconditioner: %s" % name)
+
+    return PRECONDITIONERS[name](csr_matrix(A), solver_parameters)
+
+
+@register_preconditioner("jacobi")
+def jacobi_preconditioner(A, solver_parameters):
+    diagonal = A.diagonal()
+    inv_diagonal = np.ones(len(diagonal))
+    nonzero = diagonal != 0
+    inv_diagonal[nonzero] = 1.0 / diagonal[nonzero]
+
+    return LinearOperator(A.shape, matvec=lambda x: inv_diagonal * np.ravel(x))
+
+
+@register_preconditioner("block_jacobi")
+def block_jacobi_preconditioner(A, solver_parameters):
+    """Inverts the diagonal blocks of size block_size, which are the couplings
+    between the dofs of a node when block_size is the function size"""
+    block_size = solver_parameters.get("block_size", 1)
+    n_dofs = A.shape[0]
+    n_blocks = -(-n_dofs // block_size)
+
+    # Pad the last block with identity rows if the size is not divisible
+    blocks = np.zeros((n_blocks, block_size, block_size))
+    padding = np.arange(n_dofs, n_blocks * block_size)
+    blocks[padding // block_size, padding % block_size, padding % block_size] = 1.0
+
+    A = A.tocoo()
+    same_block = A.row // block_size == A.col // block_size
+    rows = A.row[same_block]
+    cols = A.col[same_block]
+    np.add.at(
+        blocks,
+        (rows // block_size, rows % block_size, cols % block_size),
+        A.data[same_block],
+    )
+
+    # Blocks of constrained or unused dofs can be singular
+    singular = np.abs(np.linalg.det(blocks)) < 1e-300
+    blocks[singular] = np.eye(block_size)
+    inv_blocks = np.linalg.inv(blocks)
+
+    def matvec(x):
+        x_padded = np.zeros(n_blocks * block_size)
+        x_padded[:n_dofs] = np.ravel(x)
+        result = np.einsum(
+            "bij,bj->bi", inv_blocks, x_padded.reshape(n_blocks, block_size)
+        )
+        return result.reshape(-1)[:n_dofs]
+
+    return LinearOperator(A.shape, matvec=matvec)
+
+
+@register_preconditioner("ilu")
+def ilu_preconditioner(A, solver_parameters):
+    ilu = spilu(
+        A.tocsc(),
+        drop_tol=solver_parameters.get("drop_tol", None),
+        fill_factor=solver_parameters.get("fill_factor", None),
+    )
+
+    return LinearOperator(A.shape, matvec=ilu.solve)
+
+
+@register_linear_solver("scipy_sparse")
+@register_linear_solver("spsolve")
+def solve_spsolve(A, b, solver_parameters, info):
+    return spsolve(A, b)
+
+
+@register_linear_solver("splu")
+def solve_splu(A, b, solver_parameters, info):
+    lu = splu(csr_matrix(A).tocsc())
+    return lu.solve(np.asarray(b, dtype=float))
+
+
+@register_linear_solver("factorized")
+def solve_factorized(A, b, solver_parameters, info):
+    solve = factorized(csr_matrix(A).tocsc())
+    return solve(np.ravel(b).astype(float))
+
+
+def solve_krylov(method, A, b, solver_parameters, info, callback=None, **kwargs):
+    """Calls one of the scipy.sparse.linalg Krylov solvers, counting the
+    iterations and optionally recording the residual norms"""
+    parameters = inspect.signature(method).parameters
+    b = np.ravel(b)
+
+    record_residuals = solver_parameters.get("residual_history", False)
+
+    if callback is None:
+
+        def callback(x):
+            info.iterations += 1
+            if record_residuals:
+                info.residuals.append(np.linalg.norm(b - A.dot(x)))
+
+    tol = solver_parameters.get("tol", 1e-10)
+    if "rtol" in parameters:
+        kwargs["rtol"] = tol
+    else:
+        kwargs["tol"] = tol
+
+    if "atol" in parameters:
+        kwargs["atol"] = solver_parameters.get("atol", 0.0)
+
+    x, exit_code = method(
+        A,
+        b,
+        x0=solver_parameters.get("x0", None),
+        maxiter=solver_parameters.get("maxiter", None),
+        M=get_preconditioner(A, solver_parameters),
+        callback=callback,
+        **kwargs
+    )
+
+    if exit_code != 0:
+        info.converged = False
+
+    return x
+
+
+@register_linear_solver("cg")
+def solve_cg(A, b, solver_parameters, info):
+    return solve_krylov(cg, A, b, solver_parameters, info)
+
+
+@register_linear_solver("bicgstab")
+def solve_bicgstab(A, b, solver_parameters, info):
+    return solve_krylov(bicgstab, A, b, solver_parameters, info)
+
+
+@register_linear_solver("minres")
+def solve_minres(A, b, solver_parameters, info):
+    return solve_krylov(minres, A, b, solver_parameters, info)
+
+
+@register_linear_solver("gmres")
+def solve_gmres(A, b, solver_parameters, info):
+    b_norm = np.linalg.norm(b)
+    record_residuals = solver_parameters.get("residual_history", False)
+
+    # GMRES reports the preconditioned residual norm relative to b
+    def callback(residual_norm):
+        info.iterations += 1
+        if record_residuals:
+            info.residuals.append(residual_norm * b_norm)
+
+    return solve_krylov(
+        gmres,
+        A,
+        b,
+        solver_parameters,
+        info,
+        callback=callback,
+        restart=solver_parameters.get("restart", None),
+        callback_type="pr_norm",
+    )
+
+
+def run_linear_solver(A, b, solver, solver_parameters):
+    if solver_parameters.get("preconditioner", None) and not issparse(A):
+        A = csr_matrix(A)
+
+    info = SolverInfo(solver)
+    x = np.reshape(
+        get_linear_solver(solver)(A, b, solver_parameters, info), np.shape(b)
+    )
+    info.residual = np.linalg.norm(b - A.dot(x))
+
+    if info.iterations > 0:
+        logging.info(
+            "Solver %s finished in %d iterations with residual %.3e"
+            % (solver, info.iterations, info.residual)
+        )
+
+    if not info.converged:
+        raise Exception(
+            "Solver %s did not converge in %d iterations" % (solver, info.iterations)
+        )
+
+    return x, info
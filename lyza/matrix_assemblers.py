@@ -5,6 +5,8 @@ import numpy as np
 
 
 class PoissonMatrix(MatrixAssembler):
+    cacheable = True
+
     def calculate_element_matrix(self, cell):
         n_node = len(cell.nodes)
         n_dof = n_node * self.function_size
@@ -30,8 +32,28 @@ class PoissonMatrix(MatrixAssembler):
 
         return K
 
+    def calculate_element_matrices(self, batch):
+        if batch.is_affine:
+            return self.calculate_affine_element_matrices(batch)
+
+        B = batch.get_quantity("B")
+        WDETJ = batch.get_weights()
+
+        return np.einsum("cqik, cqjk, cq -> cij", B, B, WDETJ)
+
+    def calculate_affine_element_matrices(self, batch):
+        "Contracts the reference stiffness with the constant inverse Jacobians"
+        R = batch.reference.get_stiffness_tensor()
+        JINVT = batch.get_cell_quantity("JINVT")
+        DETJ = batch.get_cell_quantity("DETJ")[:, 0, 0]
+
+        metric = np.einsum("cka, ckb -> cab", JINVT, JINVT)
+
+        return np.einsum("cab, iajb, c -> cij", metric, R, DETJ)
+
 
 class MassMatrix(MatrixAssembler):
+    cacheable = True
 
     # def set_param(self, eta):
     #     self.eta = eta
@@ -59,8 +81,19 @@ class MassMatrix(MatrixAssembler):
 
         return K
 
+    def calculate_element_matrices(self, batch):
+        N = batch.get_quantity("N")[:, :, :, 0]
+        WDETJ = batch.get_weights()
+
+        return np.einsum("cqi, cqj, cq -> cij", N, N, WDETJ)
+
 
 class LinearElasticityMatrix(ElasticityBase, MatrixAssembler):
+    cacheable = True
+
+    def get_cache_parameters(self):
+        return (self.C_unvoigt.tobytes(), self.thickness)
+
     def calculate_element_matrix(self, cell):
         n_node = len(cell.nodes)
         n_dof = n_node * self.function_size
@@ -100,6 +133,46 @@ class LinearElasticityMatrix(ElasticityBase, MatrixAssembler):
 
         return K
 
+    def calculate_element_matrices(self, batch):
+        if batch.is_affine:
+            K = self.calculate_affine_element_matrices(batch)
+        else:
+            B = batch.get_quantity("B")
+            WDETJ = batch.get_weights()
+
+            K = np.einsum(
+                "xqic, acbd, xqjd, xq -> xiajb",
+                B,
+                self.C_unvoigt,
+                B,
+                WDETJ,
+                optimize=True,
+            )
+
+        n_dof = K.shape[1] * K.shape[2]
+        K = K.reshape(len(batch), n_dof, n_dof)
+
+        if self.thickness:
+            K *= self.thickness
+
+        return K
+
+    def calculate_affine_element_matrices(self, batch):
+        "Contracts the reference stiffness with the constant inverse Jacobians"
+        R = batch.reference.get_stiffness_tensor()
+        JINVT = batch.get_cell_quantity("JINVT")
+        DETJ = batch.get_cell_quantity("DETJ")[:, 0, 0]
+
+        return np.einsum(
+            "iejf, xce, acbd, xdf, x -> xiajb",
+            R,
+            JINVT,
+            self.C_unvoigt,
+            JINVT,
+            DETJ,
+            optimize=True,
+        )
+
 
 class InelasticityJacobianMatrix(MatrixAssembler):
     def calculate_element_matrix(self, cell):
@@ -125,6 +198,18 @@ class InelasticityJacobianMatrix(MatrixAssembler):
 
         return K
 
+    def calculate_element_matrices(self, batch):
+        B = batch.get_quantity("B")
+        CTENSOR = batch.get_quantity("CTENSOR")
+        WDETJ = batch.get_weights()
+        n_dof = B.shape[2] * B.shape[3]
+
+        K = np.einsum(
+            "xqic, xqacbd, xqjd, xq -> xiajb", B, CTENSOR, B, WDETJ, optimize=True
+        )
+
+        return K.reshape(len(batch), n_dof, n_dof)
+
 
 class HyperelasticityJacobian(MatrixAssembler):
     identity = np.eye(3)
@@ -173,3 +258,30 @@ class HyperelasticityJacobian(MatrixAssembler):
             K += K_higher
 
         return K
+
+    def calculate_element_matrices(self, batch):
+        BBAR = batch.get_quantity("BBAR")
+        LCG = batch.get_quantity("LCG")
+        TAU = batch.get_quantity("TAU")
+        WDETJ = batch.get_weights()
+        n_dof = BBAR.shape[2] * BBAR.shape[3]
+
+        c_eul = self.lambda_ * np.einsum("xqab, xqcd -> xqabcd", LCG, LCG) + self.mu * (
+            np.einsum("xqac, xqbd -> xqabcd", LCG, LCG)
+            + np.einsum("xqad, xqbc -> xqabcd", LCG, LCG)
+        )
+
+        K = np.einsum(
+            "xqic, xqacbd, xqjd, xq -> xiajb", BBAR, c_eul, BBAR, WDETJ, optimize=True
+        )
+        K += np.einsum(
+            "xqie, xqef, xqjf, ab, xq -> xiajb",
+            BBAR,
+            TAU,
+            BBAR,
+            self.identity,
+            WDETJ,
+            optimize=True,
+        )
+
+        return K.reshape(len(batch), n_dof, n_dof)
@@ -515,3 +515,168 @@ class ElasticityBase:
         self.C_unvoigt = unvoigt4(self.C)
 
         self.thickness = thickness
+
+
+class MaterialModel:
+    """Constitutive model that is evaluated at all quadrature points at once.
+    update receives the strain measure named by strain_key with shape
+    (n, 3, 3) and the history of the previous step, a dict with arrays of
+    shape (n,) + shape for the keys and shapes in history. It returns the
+    stress (n, 3, 3), the tangent (n, 3, 3, 3, 3) and the updated history"""
+
+    strain_key = "EPS"
+    history = {}
+
+    def update(self, strain, history):
+        raise Exception("Do not use base class")
+
+
+def deviatoric_batch(A):
+    return A - np.trace(A, axis1=1, axis2=2)[:, None, None] / 3 * IDENTITY
+
+
+def stack_tensor(tensor, n):
+    return np.broadcast_to(tensor, (n,) + tensor.shape)
+
+
+class J2Plasticity(MaterialModel):
+    """Small strain J2 plasticity with linear isotropic hardening, integrated
+    with the radial return mapping. The history is the plastic strain EPSP and
+    the equivalent plastic strain ALPHA"""
+
+    history = {"EPSP": (3, 3), "ALPHA": (1, 1)}
+
+    def __init__(self, kappa, mu, yield_stress, hardening_modulus):
+        self.kappa = kappa
+        self.mu = mu
+        self.yield_stress = yield_stress
+        self.hardening_modulus = hardening_modulus
+
+    def update(self, strain, history):
+        mu = self.mu
+        H = self.hardening_modulus
+        n_point = len(strain)
+
+        eps_p_n = history["EPSP"]
+        alpha_n = history["ALPHA"][:, 0, 0]
+
+        tr_eps = np.trace(strain, axis1=1, axis2=2)
+        sigma_dev_tr = 2.0 * mu * (deviatoric_batch(strain) - eps_p_n)
+        norm_xi_tr = np.sqrt(np.einsum("nij, nij -> n", sigma_dev_tr, sigma_dev_tr))
+        phi_tr = norm_xi_tr - np.sqrt(2 / 3) * (self.yield_stress + H * alpha_n)
+
+        # Points whose trial state is outside the yield surface
+        plastic = phi_tr > 0
+
+        gamma = np.zeros(n_point)
+        n = np.zeros((n_point, 3, 3))
+        gamma[plastic] = phi_tr[plastic] / (2 * mu + (2 / 3) * H)
+        n[plastic] = sigma_dev_tr[plastic] / norm_xi_tr[plastic, None, None]
+
+        sigma_dev = sigma_dev_tr - 2 * mu * gamma[:, None, None] * n
+
+        C = stack_tensor(
+            self.kappa * IDENTITY_DYADIC_IDENTITY + 2 * mu * PROJECTION4, n_point
+        ).copy()
+
+        if np.any(plastic):
+            ratio = phi_tr[plastic] / norm_xi_tr[plastic]
+            c1 = 1 - 1 / (1 + H / (3 * mu)) * ratio
+            c2 = 1 / (1 + H / (3 * mu)) * (1 - ratio)
+            n_dyadic_n = np.einsum("nij, nkl -> nijkl", n[plastic], n[plastic])
+
+            C[plastic] = (
+                self.kappa * IDENTITY_DYADIC_IDENTITY
+                + 2 * mu * c1[:, None, None, None, None] * PROJECTION4
+                - 2 * mu * c2[:, None, None, None, None] * n_dyadic_n
+            )
+
+        sigma = self.kappa * tr_eps[:, None, None] * IDENTITY + sigma_dev
+        eps_p = eps_p_n + (sigma_dev_tr - sigma_dev) / (2 * mu)
+        alpha = alpha_n + np.sqrt(2 / 3) * gamma
+
+        return sigma, C, {"EPSP": eps_p, "ALPHA": alpha[:, None, None]}
+
+
+class LinearViscoelasticity(MaterialModel):
+    """Standard linear solid with the equilibrium shear modulus mu0 and a
+    Maxwell element with the shear modulus mu1 and the viscosity eta,
+    integrated with the implicit Euler method over the step delta_t. The
+    history is the viscous strain ALPHA"""
+
+    history = {"ALPHA": (3, 3)}
+
+    def __init__(self, kappa, mu0, mu1, eta, delta_t):
+        self.kappa = kappa
+        self.mu0 = mu0
+        self.mu1 = mu1
+        self.eta = eta
+        self.delta_t = delta_t
+
+    def update(self, strain, history):
+        tr_eps = np.trace(strain, axis1=1, axis2=2)
+        eps_dev = deviatoric_batch(strain)
+        ratio = self.delta_t / (self.eta / 2 / self.mu1)
+
+        alpha = 1 / (1 + ratio) * (history["ALPHA"] + ratio * eps_dev)
+        sigma = (
+            self.kappa * tr_eps[:, None, None] * IDENTITY
+            + 2 * self.mu0 * eps_dev
+            + 2 * self.mu1 * (eps_dev - alpha)
+        )
+        C = (
+            self.kappa * IDENTITY_DYADIC_IDENTITY
+            + (2 * self.mu0 + 2 * self.mu1 / (1 + ratio)) * PROJECTION4
+        )
+
+        return sigma, stack_tensor(C, len(strain)), {"ALPHA": alpha}
+
+
+class SaintVenantKirchhoff(MaterialModel):
+    """Hyperelastic model with the second Piola-Kirchhoff stress
+    lambda tr(E) I + 2 mu E. The strain measure is the deformation gradient F,
+    the stress is the Kirchhoff stress and the tangent is the push-forward of
+    the material tangent, as used by HyperelasticityJacobian"""
+
+    strain_key = "F"
+
+    def __init__(self, lambda_, mu):
+        self.lambda_ = lambda_
+        self.mu = mu
+
+    def update(self, strain, history):
+        b = np.einsum("nij, nkj -> nik", strain, strain)
+        tr_b = np.trace(b, axis1=1, axis2=2)
+
+        tau = (self.lambda_ / 2 * (tr_b - 3) - self.mu)[:, None, None] * b
+        tau += self.mu * np.einsum("nij, njk -> nik", b, b)
+
+        c = self.lambda_ * np.einsum("nab, ncd -> nabcd", b, b) + self.mu * (
+            np.einsum("nac, nbd -> nabcd", b, b) + np.einsum("nad, nbc -> nabcd", b, b)
+        )
+
+        return tau, c, {}
+
+
+class NeoHookean(MaterialModel):
+    """Compressible neo-Hookean model with the Kirchhoff stress
+    mu (b - I) + lambda ln(J) I. The strain measure, stress and tangent are
+    the same as for SaintVenantKirchhoff"""
+
+    strain_key = "F"
+
+    def __init__(self, lambda_, mu):
+        self.lambda_ = lambda_
+        self.mu = mu
+
+    def update(self, strain, history):
+        b = np.einsum("nij, nkj -> nik", strain, strain)
+        log_J = np.log(np.linalg.det(strain))
+
+        tau = self.mu * (b - IDENTITY) + self.lambda_ * log_J[:, None, None] * IDENTITY
+
+        c = self.lambda_ * IDENTITY_DYADIC_IDENTITY + 2 * (
+            self.mu - self.lambda_ * log_J[:, None, None, None, None]
+        ) * stack_tensor(IDENTITY4, len(strain))
+
+        return tau, c, {}
@@ -1,35 +1,113 @@
+import numpy as np
 from lyza.node import Node
 from lyza.cell_quantity import CellQuantity
 from lyza.function import Function
 from lyza.domain import DefaultDomain
+from lyza.helper import batch_determinant, batch_inverse
 import time
 import logging
 
+# Relative variation of the Jacobian over a cell below which it is constant
+AFFINE_TOLERANCE = 1e-10
+
 
 class Mesh:
+    """Node coordinates are stored in the (n_node, 3) array coordinates, and
+    the node indices of the cells of each type in the integer arrays of
+    connectivity. Node objects are views into the coordinate array."""
+
     def __init__(self):
         self.nodes = []
         self.cells = []
         self.boundary_cells = []
-        self.quantitites = {}
+        self.quantities = {}
 
-        self.construct_mesh()
+        self.coordinates = np.zeros((0, 3))
+        self._coordinate_buffer = np.zeros((0, 3))
 
-        for idx, n in enumerate(self.nodes):
-            n.idx = idx
+        self.construct_mesh()
 
-        for idx, c in enumerate(self.cells):
-            c.idx = idx
+        self.update_arrays()
 
     def construct_mesh(self):
         pass
 
     def add_node(self, coors):
-        self.nodes.append(Node(coors, len(self.nodes)))
+        self.add_nodes(np.array(coors, dtype=float).reshape(1, 3))
+
+    def add_nodes(self, coordinates):
+        "Adds the nodes of an (n, 3) coordinate array"
+        coordinates = np.asarray(coordinates, dtype=float)
+        if coordinates.ndim != 2 or coordinates.shape[1] != 3:
+            raise Exception("Invalid shape")
+
+        start = len(self.nodes)
+        end = start + len(coordinates)
+
+        if end > len(self._coordinate_buffer):
+            buffer = np.zeros((max(end, 2 * len(self._coordinate_buffer)), 3))
+            buffer[:start] = self.coordinates
+            self._coordinate_buffer = buffer
+
+        self._coordinate_buffer[start:end] = coordinates
+        self.coordinates = self._coordinate_buffer[:end]
+
+        self.nodes.extend([Node(None, idx, mesh=self) for idx in range(start, end)])
 
     def add_cell(self, cell):
         self.cells.append(cell)
 
+    def add_cells(self, cell_type, connectivity, is_boundary=False):
+        "Adds cells of the same type from an (n_cell, n_node) array of node indices"
+        nodes = self.nodes
+
+        for node_indices in np.asarray(connectivity).tolist():
+            self.add_cell(
+                cell_type([nodes[i] for i in node_indices], is_boundary=is_boundary)
+            )
+
+    def update_arrays(self):
+        "Builds the coordinate and connectivity arrays from nodes and cells"
+        if all(n.mesh is self and n.idx == idx for idx, n in enumerate(self.nodes)):
+            coordinates = self.coordinates.copy()
+        else:
+            # Nodes were created outside add_node
+            coordinates = np.array([n.coor[:, 0] for n in self.nodes]).reshape(-1, 3)
+
+        self.coordinates = coordinates
+        self._coordinate_buffer = coordinates
+
+        for idx, n in enumerate(self.nodes):
+            n.mesh = self
+            n.idx = idx
+            n._coor = None
+
+        cell_type_indices = {}
+        for idx, c in enumerate(self.cells):
+            c.idx = idx
+            cell_type_indices.setdefault(type(c), []).append(idx)
+
+        self.connectivity = {}
+        self.cell_type_indices = {}
+        self.cell_type_rows = np.zeros(len(self.cells), dtype=np.int64)
+        self.cell_type_codes = np.zeros(len(self.cells), dtype=np.int64)
+
+        for code, (cell_type, indices) in enumerate(cell_type_indices.items()):
+            self.connectivity[cell_type] = np.array(
+                [[n.idx for n in self.cells[i].nodes] for i in indices],
+                dtype=np.int64,
+            )
+            self.cell_type_indices[cell_type] = np.array(indices, dtype=np.int64)
+            self.cell_type_rows[indices] = np.arange(len(indices))
+            self.cell_type_codes[indices] = code
+
+    def get_cell_node_indices(self, cell_indices):
+        "Returns an (n_cell, n_node) array for cells of the same type"
+        cell_indices = np.asarray(cell_indices, dtype=np.int64)
+        cell_type = type(self.cells[cell_indices[0]])
+
+        return self.connectivity[cell_type][self.cell_type_rows[cell_indices]]
+
     def get_n_nodes(self):
         return len(self.nodes)
 
@@ -39,6 +117,7 @@ class Mesh:
         spatial_dim,
         domain=DefaultDomain(),
         skip_basis=False,
+        detect_affine=True,
     ):
 
         start = time.time()
@@ -47,86 +126,131 @@ class Mesh:
         # if not domain:
         # domain = DefaultDomain()
 
+        self.quadrature_degrees = np.full(len(self.cells), -1, dtype=np.int64)
+        self.affine_cells = np.zeros(len(self.cells), dtype=bool)
+
         quad_weight = CellQuantity(self, (1, 1))
         quad_coor = CellQuantity(self, (3, 1))
 
-        for idx, cell in enumerate(self.cells):
-            if not domain.is_subset(cell):
-                continue
-
-            degree = quadrature_degree_map(cell)
-            quad_weights, quad_coors = cell.get_quad_points(degree)
-
-            for weight in quad_weights:
-                quad_weight.add_quantity_by_cell_idx(idx, weight)
-
-            for coor in quad_coors:
-                quad_coor.add_quantity_by_cell_idx(idx, coor)
-
         self.quantities = {
             "XL": quad_coor,
             "W": quad_weight,
         }
 
         if not skip_basis:
-            N = CellQuantity(self, None)
-            B = CellQuantity(self, None)
-            J = CellQuantity(self, None)
-            DETJ = CellQuantity(self, (1, 1))
-            JINVT = CellQuantity(self, None)
-            XG = CellQuantity(self, (3, 1))
-
-            for idx, cell in enumerate(self.cells):
-                if not domain.is_subset(cell):
-                    continue
-
-                degree = quadrature_degree_map(cell)
-
-                (
-                    N_arr,
-                    B_arr,
-                    J_arr,
-                    DETJ_arr,
-                    JINVT_arr,
-                    XG_arr,
-                ) = cell.calculate_basis_values(spatial_dim, degree)
-
-                for i in N_arr:
-                    N.add_quantity_by_cell_idx(idx, i)
-                for i in B_arr:
-                    B.add_quantity_by_cell_idx(idx, i)
-                for i in J_arr:
-                    J.add_quantity_by_cell_idx(idx, i)
-                for i in DETJ_arr:
-                    DETJ.add_quantity_by_cell_idx(idx, i)
-                for i in JINVT_arr:
-                    JINVT.add_quantity_by_cell_idx(idx, i)
-                for i in XG_arr:
-                    XG.add_quantity_by_cell_idx(idx, i)
-
-        self.quantities = {
-            **self.quantities,
-            "N": N,
-            "B": B,
-            "J": J,
-            "DETJ": DETJ,
-            "JINVT": JINVT,
-            "XG": XG,
-        }
+            for key, shape in [
+                ("N", None),
+                ("B", None),
+                ("J", None),
+                ("DETJ", (1, 1)),
+                ("JINVT", None),
+                ("XG", (3, 1)),
+            ]:
+                self.quantities[key] = CellQuantity(self, shape)
+
+        # Cells of the same type and degree share the reference values, so
+        # that the geometry of each group is computed with stacked arrays
+        groups = {}
+        for idx in domain.get_cell_indices(self):
+            cell = self.cells[idx]
+            degree = quadrature_degree_map(cell)
+            groups.setdefault((type(cell), degree), []).append(idx)
+
+        for (cell_type, degree), cell_indices in groups.items():
+            cell_indices = np.array(cell_indices, dtype=np.int64)
+            reference = self.cells[cell_indices[0]].get_reference_values(degree)
+            self.quadrature_degrees[cell_indices] = degree
+            batch_shape = (len(cell_indices), reference.n_point)
+
+            quad_weight.set_quantity_batch(
+                cell_indices,
+                np.broadcast_to(
+                    reference.weights[None, :, None, None], batch_shape + (1, 1)
+                ),
+            )
+            quad_coor.set_quantity_batch(
+                cell_indices,
+                np.broadcast_to(
+                    reference.points[None, :, :, None], batch_shape + (3, 1)
+                ),
+            )
+
+            if not skip_basis:
+                self.set_basis_values(
+                    cell_indices, reference, spatial_dim, detect_affine=detect_affine
+                )
 
         logging.debug(
             "Finished setting quadrature degree in %fs" % (time.time() - start)
         )
 
+    def set_basis_values(
+        self, cell_indices, reference, spatial_dim, detect_affine=True
+    ):
+        """Computes the basis values of cells with the same type and degree at
+        once. Cells whose Jacobian is constant store J, DETJ and JINVT only once"""
+        # Node coordinates with shape (n_cell, n_node, 3)
+        X = self.coordinates[self.get_cell_node_indices(cell_indices)]
+        n_node = X.shape[1]
+        n_point = reference.n_point
+        batch_shape = (len(cell_indices), n_point)
+
+        # Stacked arrays with shape (n_cell, n_point, ...)
+        J = np.einsum("cni,qnj->cqij", X[:, :, :spatial_dim], reference.dN)
+        XG = np.einsum("cni,qn->cqi", X, reference.N)
+        N = np.broadcast_to(reference.N[None, :, :, None], batch_shape + (n_node, 1))
+
+        self.quantities["N"].set_quantity_batch(cell_indices, N)
+        self.quantities["XG"].set_quantity_batch(cell_indices, XG[:, :, :, None])
+
+        if detect_affine:
+            variation = np.abs(J - J[:, :1]).max(axis=(1, 2, 3))
+            affine = variation <= AFFINE_TOLERANCE * np.abs(J).max(axis=(1, 2, 3))
+        else:
+            affine = np.zeros(len(cell_indices), dtype=bool)
+
+        self.affine_cells[cell_indices] = affine
+
+        if np.any(affine):
+            J_affine = J[affine, 0]
+            JINV = batch_inverse(J_affine)
+
+            self.quantities["J"].set_constant_batch(
+                cell_indices[affine], J_affine, n_point
+            )
+            self.quantities["DETJ"].set_constant_batch(
+                cell_indices[affine],
+                batch_determinant(J_affine)[:, None, None],
+                n_point,
+            )
+            self.quantities["JINVT"].set_constant_batch(
+                cell_indices[affine], np.swapaxes(JINV, -1, -2), n_point
+            )
+            self.quantities["B"].set_quantity_batch(
+                cell_indices[affine], np.einsum("qnj,cjk->cqnk", reference.dN, JINV)
+            )
+
+        if not np.all(affine):
+            J = J[~affine]
+            JINV = batch_inverse(J)
+
+            self.quantities["J"].set_quantity_batch(cell_indices[~affine], J)
+            self.quantities["DETJ"].set_quantity_batch(
+                cell_indices[~affine], batch_determinant(J)[:, :, None, None]
+            )
+            self.quantities["JINVT"].set_quantity_batch(
+                cell_indices[~affine], np.swapaxes(JINV, -1, -2)
+            )
+            self.quantities["B"].set_quantity_batch(
+                cell_indices[~affine], np.einsum("qnj,cqjk->cqnk", reference.dN, JINV)
+            )
+
     def get_position_function(self, spatial_dimension):
         if spatial_dimension > 3:
             raise Exception()
 
         result = Function(self, spatial_dimension)
-
-        for i, n in enumerate(self.nodes):
-            for j in range(spatial_dimension):
-                result.vector[i * spatial_dimension + j] = n.coor[j]
+        result.vector[:, 0] = self.coordinates[:, :spatial_dimension].ravel()
 
         return result
 
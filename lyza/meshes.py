@@ -1,6 +1,7 @@
 from math import pi as pi_val
 from lyza.mesh import Mesh
 from lyza.cells import Hex, Quad, Line
+import numpy as np
 import copy
 
 
@@ -19,7 +20,7 @@ def line_intersection(line1, line2):
         return a[0] * b[1] - a[1] * b[0]
 
     div = det(xdiff, ydiff)
-    if div == 0:
+    if np.any(np.asarray(div) == 0):
         # import ipdb; ipdb.set_trace()
         raise Exception("lines do not intersect")
 
@@ -42,39 +43,54 @@ class QuadMesh(Mesh):
         super().__init__()
 
     def construct_mesh(self):
+        x = np.tile(np.arange(self.res_x + 1), self.res_y + 1)
+        y = np.repeat(np.arange(self.res_y + 1), self.res_x + 1)
+
+        point_down = locate_midpoint(self.p0, self.p1, x / self.res_x)
+        point_up = locate_midpoint(self.p3, self.p2, x / self.res_x)
+
+        point_left = locate_midpoint(self.p0, self.p3, y / self.res_y)
+        point_right = locate_midpoint(self.p1, self.p2, y / self.res_y)
+
+        coor = line_intersection((point_left, point_right), (point_down, point_up))
+
+        coordinates = np.zeros((len(x), 3))
+        coordinates[:, 0:2] = np.array(coor).T
+        self.add_nodes(coordinates)
+
+        def node_index(x, y):
+            return y * (self.res_x + 1) + x
+
+        x, y = np.meshgrid(np.arange(self.res_x), np.arange(self.res_y))
+        x, y = x.ravel(), y.ravel()
+        self.add_cells(
+            Quad,
+            np.stack(
+                [
+                    node_index(x, y),
+                    node_index(x + 1, y),
+                    node_index(x + 1, y + 1),
+                    node_index(x, y + 1),
+                ],
+                axis=1,
+            ),
+        )
 
-        for y in range(self.res_y + 1):
-            for x in range(self.res_x + 1):
-                point_down = locate_midpoint(self.p0, self.p1, x / self.res_x)
-                point_up = locate_midpoint(self.p3, self.p2, x / self.res_x)
-
-                point_left = locate_midpoint(self.p0, self.p3, y / self.res_y)
-                point_right = locate_midpoint(self.p1, self.p2, y / self.res_y)
-
-                coor = line_intersection(
-                    (point_left, point_right), (point_down, point_up)
-                )
-                self.add_node(coor + [0.0])
-
-        for y in range(self.res_y):
-            for x in range(self.res_x):
-                n0 = self.nodes[y * (self.res_x + 1) + x]
-                n1 = self.nodes[y * (self.res_x + 1) + x + 1]
-                n2 = self.nodes[(y + 1) * (self.res_x + 1) + x + 1]
-                n3 = self.nodes[(y + 1) * (self.res_x + 1) + x]
-                self.add_cell(Quad([n0, n1, n2, n3]))
-
-        for y in range(self.res_y):
-            for x in range(self.res_x + 1):
-                n0 = self.nodes[y * (self.res_x + 1) + x]
-                n1 = self.nodes[(y + 1) * (self.res_x + 1) + x]
-                self.add_cell(Line([n0, n1], is_boundary=True))
+        x, y = np.meshgrid(np.arange(self.res_x + 1), np.arange(self.res_y))
+        x, y = x.ravel(), y.ravel()
+        self.add_cells(
+            Line,
+            np.stack([node_index(x, y), node_index(x, y + 1)], axis=1),
+            is_boundary=True,
+        )
 
-        for y in range(self.res_y + 1):
-            for x in range(self.res_x):
-                n0 = self.nodes[y * (self.res_x + 1) + x]
-                n1 = self.nodes[y * (self.res_x + 1) + x + 1]
-                self.add_cell(Line([n0, n1], is_boundary=True))
+        x, y = np.meshgrid(np.arange(self.res_x), np.arange(self.res_y + 1))
+        x, y = x.ravel(), y.ravel()
+        self.add_cells(
+            Line,
+            np.stack([node_index(x, y), node_index(x + 1, y)], axis=1),
+            is_boundary=True,
+        )
 
 
 class UnitSquareMesh(QuadMesh):
@@ -97,25 +113,29 @@ class Cantilever3D(Mesh):
     def construct_mesh(self):
         cell_x_len = self.length / self.resolution
 
-        for x in range(self.resolution + 1):
-            point_0 = [x * cell_x_len, 0.0, 0.0]
-            point_3 = [x * cell_x_len, self.horizontal_width, 0.0]
-            point_4 = [x * cell_x_len, self.horizontal_width, self.vertical_width]
-            point_7 = [x * cell_x_len, 0.0, self.vertical_width]
-
-            self.add_node(point_0)
-            self.add_node(point_3)
-            self.add_node(point_4)
-            self.add_node(point_7)
-
-        for i in range(self.resolution):
-            n0 = self.nodes[i * 4]
-            n1 = self.nodes[(i + 1) * 4]
-            n2 = self.nodes[(i + 1) * 4 + 1]
-            n3 = self.nodes[i * 4 + 1]
-            n4 = self.nodes[i * 4 + 3]
-            n5 = self.nodes[(i + 1) * 4 + 3]
-            n6 = self.nodes[(i + 1) * 4 + 2]
-            n7 = self.nodes[i * 4 + 2]
-
-            self.add_cell(Hex([n0, n1, n2, n3, n4, n5, n6, n7]))
+        x = np.arange(self.resolution + 1) * cell_x_len
+
+        # Points 0, 3, 4 and 7 of the cross section at each x
+        coordinates = np.zeros((self.resolution + 1, 4, 3))
+        coordinates[:, :, 0] = x[:, None]
+        coordinates[:, 1:3, 1] = self.horizontal_width
+        coordinates[:, 2:4, 2] = self.vertical_width
+        self.add_nodes(coordinates.reshape(-1, 3))
+
+        i = np.arange(self.resolution)
+        self.add_cells(
+            Hex,
+            np.stack(
+                [
+                    i * 4,
+                    (i + 1) * 4,
+                    (i + 1) * 4 + 1,
+                    i * 4 + 1,
+                    i * 4 + 3,
+                    (i + 1) * 4 + 3,
+                    (i + 1) * 4 + 2,
+                    i * 4 + 2,
+                ],
+                axis=1,
+            ),
+        )
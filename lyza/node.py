@@ -2,18 +2,41 @@ import numpy as np
 
 
 class Node:
-    def __init__(self, coor, idx, label=None):
-        if isinstance(coor, list):
-            coor = np.array(coor).reshape(3, 1)
+    """A mesh node. Nodes that belong to a mesh do not store their own
+    coordinates, they are views into the coordinate array of the mesh."""
 
-        if coor.shape != (3, 1):
-            raise Exception("Invalid shape")
+    __slots__ = ("_coor", "mesh", "idx", "label")
 
-        self.coor = coor
+    def __init__(self, coor, idx, label=None, mesh=None):
+        self.mesh = mesh
         self.label = label
         self.idx = idx
+        self._coor = None
+
+        if mesh is None:
+            self.coor = coor
 
         # self.spatial_dim = spatial_dim
         # self.dofmap = []
         # for i in range(self.spatial_dim):
         #     self.dofmap.append(idx*self.spatial_dim+i)
+
+    @property
+    def coor(self):
+        if self.mesh is None:
+            return self._coor
+        else:
+            return self.mesh.coordinates[self.idx, :, None]
+
+    @coor.setter
+    def coor(self, coor):
+        if isinstance(coor, list):
+            coor = np.array(coor).reshape(3, 1)
+
+        if coor.shape != (3, 1):
+            raise Exception("Invalid shape")
+
+        if self.mesh is None:
+            self._coor = coor
+        else:
+            self.mesh.coordinates[self.idx] = coor[:, 0]
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+
+BACKENDS = ["serial", "threads", "processes"]
+
+backend = {"name": "serial", "n_workers": 1}
+
+# Work of the running process pool assembly, inherited by the forked workers
+process_state = {}
+
+
+def set_assembly_backend(name, n_workers=None):
+    "Selects how the assemblers compute and scatter the element arrays"
+    if name not in BACKENDS:
+        raise Exception("Unknown assembly backend: %s" % name)
+
+    if n_workers is None:
+        n_workers = 1 if name == "serial" else os.cpu_count() or 1
+
+    backend["name"] = name
+    backend["n_workers"] = n_workers
+
+
+def get_assembly_backend():
+    return backend["name"], backend["n_workers"]
+
+
+def color_cells(cell_indices, cell_dofs):
+    """Greedily colors the cells so that no two cells of the same color share a
+    dof. Returns an array with the color of each cell in cell_indices"""
+    dof_colors = {}
+    colors = np.zeros(len(cell_indices), dtype=np.int64)
+
+    for i, idx in enumerate(cell_indices):
+        dofs = cell_dofs[idx]
+
+        # Bit c of used is set if a neighbor already has color c
+        used = 0
+        for dof in dofs:
+            used |= dof_colors.get(dof, 0)
+
+        color = (~used & (used + 1)).bit_length() - 1
+        colors[i] = color
+
+        for dof in dofs:
+            dof_colors[dof] = dof_colors.get(dof, 0) | (1 << color)
+
+    return colors
+
+
+def split_indices(indices, n_chunks):
+    "Splits into at most n_chunks contiguous nonempty parts"
+    return [i for i in np.array_split(indices, n_chunks) if len(i) > 0]
+
+
+def run_colored(tasks_by_color, function, n_workers):
+    """Calls function on every task. Tasks of the same color run concurrently,
+    and the colors run one after another"""
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for tasks in tasks_by_color:
+            # Consume the iterator to wait for the color and raise any errors
+            list(executor.map(function, tasks))
+
+
+def run_in_processes(function, partitions, sizes, n_workers):
+    """Calls function(partition) for every partition in a pool of forked
+    processes and returns the concatenation of the returned flat arrays, where
+    the array of partition i has sizes[i] values. The workers inherit the
+    memory of the parent, so neither function nor the mesh and its quantities
+    need to be picklable, and they write their results into shared memory.
+    Changes that function makes to the mesh are not seen by the parent"""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise Exception("The processes backend needs the fork start method")
+
+    offsets = np.cumsum([0] + list(sizes))
+    memory = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]), 1) * 8)
+
+    try:
+        output = np.ndarray((offsets[-1],), dtype=np.float64, buffer=memory.buf)
+
+        process_state.update(
+            function=function, partitions=partitions, offsets=offsets, output=output
+        )
+
+        context = multiprocessing.get_context("fork")
+        with context.Pool(min(n_workers, len(partitions))) as pool:
+            pool.map(run_partition, range(len(partitions)))
+
+        result = output.copy()
+        del output
+    finally:
+        process_state.clear()
+        memory.close()
+        memory.unlink()
+
+    return result
+
+
+def run_partition(partition_idx):
+    start = process_state["offsets"][partition_idx]
+    end = process_state["offsets"][partition_idx + 1]
+
+    values = process_state["function"](process_state["partitions"][partition_idx])
+    process_state["output"][start:end] = values
@@ -1,5 +1,5 @@
 import numpy as np
-import sympy as sp
+from scipy.sparse import issparse
 
 
 def partition_system(A, b, rem_dofmap, sort=True):
@@ -8,53 +8,49 @@ def partition_system(A, b, rem_dofmap, sort=True):
     return A_uu, A_ku, A_uk, A_kk, b_u, b_k
 
 
+def get_complement_dofmap(rem_dofmap, n_dofs):
+    "Returns the sorted dofs that are not in rem_dofmap"
+    mask = np.ones(n_dofs, dtype=bool)
+    mask[np.asarray(rem_dofmap, dtype=np.int64)] = False
+    return np.flatnonzero(mask)
+
+
 def partition_vector(b, rem_dofmap, sort=True):
     if sort:
         rem_dofmap = sorted(rem_dofmap)
-    res_dofmap = list(range(len(b)))
-    for i in sorted(rem_dofmap, reverse=True):
-        del res_dofmap[i]
-
-    b_u = np.zeros((len(rem_dofmap), 1))
-    b_k = np.zeros((len(res_dofmap), 1))
+    rem_dofmap = np.asarray(rem_dofmap, dtype=np.int64)
+    res_dofmap = get_complement_dofmap(rem_dofmap, len(b))
 
-    for n_i, idx_i in enumerate(rem_dofmap):
-        b_u[n_i] = b[idx_i]
+    b = np.asarray(b, dtype=float).reshape(len(b), 1)
 
-    for n_i, idx_i in enumerate(res_dofmap):
-        b_k[n_i] = b[idx_i]
+    b_u = b[rem_dofmap]
+    b_k = b[res_dofmap]
 
     return b_u, b_k
 
 
 def partition_matrix(A, rem_dofmap, sort=True):
+    """Partitions the matrix with fancy indexing. Sparse matrices are returned
+    in CSR format, and everything else as dense arrays"""
     if sort:
         rem_dofmap = sorted(rem_dofmap)
-    res_dofmap = list(range(A.shape[0]))
-
-    for i in sorted(rem_dofmap, reverse=True):
-        del res_dofmap[i]
-
-    A_uu = np.zeros((len(rem_dofmap), len(rem_dofmap)))
-    A_ku = np.zeros((len(res_dofmap), len(rem_dofmap)))
-    A_uk = np.zeros((len(rem_dofmap), len(res_dofmap)))
-    A_kk = np.zeros((len(res_dofmap), len(res_dofmap)))
-
-    for n_i, idx_i in enumerate(rem_dofmap):
-        for n_j, idx_j in enumerate(rem_dofmap):
-            A_uu[n_i][n_j] = A[idx_i, idx_j]
-
-    for n_i, idx_i in enumerate(res_dofmap):
-        for n_j, idx_j in enumerate(rem_dofmap):
-            A_ku[n_i][n_j] = A[idx_i, idx_j]
-
-    for n_i, idx_i in enumerate(rem_dofmap):
-        for n_j, idx_j in enumerate(res_dofmap):
-            A_uk[n_i][n_j] = A[idx_i, idx_j]
-
-    for n_i, idx_i in enumerate(res_dofmap):
-        for n_j, idx_j in enumerate(res_dofmap):
-            A_kk[n_i][n_j] = A[idx_i, idx_j]
+    rem_dofmap = np.asarray(rem_dofmap, dtype=np.int64)
+    res_dofmap = get_complement_dofmap(rem_dofmap, A.shape[0])
+
+    if issparse(A):
+        A = A.tocsr()
+        A_u = A[rem_dofmap, :]
+        A_k = A[res_dofmap, :]
+        A_uu = A_u[:, rem_dofmap]
+        A_uk = A_u[:, res_dofmap]
+        A_ku = A_k[:, rem_dofmap]
+        A_kk = A_k[:, res_dofmap]
+    else:
+        A = np.asarray(A, dtype=float)
+        A_uu = A[np.ix_(rem_dofmap, rem_dofmap)]
+        A_ku = A[np.ix_(res_dofmap, rem_dofmap)]
+        A_uk = A[np.ix_(rem_dofmap, res_dofmap)]
+        A_kk = A[np.ix_(res_dofmap, res_dofmap)]
 
     return A_uu, A_ku, A_uk, A_kk
 
@@ -68,6 +64,8 @@ def partition_system_sympy(A, b, rem_dofmap, res_dofmap=None, sort=True):
 
 
 def partition_vector_sympy(b, rem_dofmap, res_dofmap=None, sort=True):
+    import sympy as sp
+
     if sort:
         rem_dofmap = sorted(rem_dofmap)
 
@@ -89,6 +87,8 @@ def partition_vector_sympy(b, rem_dofmap, res_dofmap=None, sort=True):
 
 
 def partition_matrix_sympy(A, rem_dofmap, res_dofmap=None, sort=True):
+    import sympy as sp
+
     if sort:
         rem_dofmap = sorted(rem_dofmap)
     if not res_dofmap:
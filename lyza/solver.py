@@ -1,10 +1,12 @@
 import numpy as np
 import logging
 from scipy.sparse.linalg import spsolve
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, diags, issparse
 import time
 
 from lyza.function import Function
+from lyza.partition_system import partition_system
+from lyza.linear_solvers import run_linear_solver, SolverInfo
 from lyza.vtk import VTKFile
 
 
@@ -14,31 +16,47 @@ def solve(
     dirichlet_bcs,
     solver="scipy_sparse",
     solver_parameters={},
+    bc_method="identity",
+    residual_history=False,
+    return_info=False,
 ):
+    """Solves the linear problem. With return_info, the SolverInfo of the
+    linear solve is returned as a third value"""
 
     function = Function(matrix_assembler.mesh, matrix_assembler.function_size)
 
+    # Block preconditioners operate on the dofs of each node by default
+    solver_parameters = dict(
+        {"block_size": matrix_assembler.function_size}, **solver_parameters
+    )
+    if residual_history:
+        solver_parameters["residual_history"] = True
+
     A = matrix_assembler.assemble()
-    f_bc = vector_assembler.assemble()
+    f = vector_assembler.assemble()
 
     start_time = time.time()
-    A_bc, f_bc = apply_bcs(
-        A,
-        f_bc,
+    dirichlet_dofs = get_dirichlet_dofs(
         matrix_assembler.mesh,
         matrix_assembler.node_dofs,
         matrix_assembler.function_size,
         dirichlet_bcs,
     )
-    logging.debug("Applied bcs in %f sec" % (time.time() - start_time))
+    logging.debug("Evaluated bcs in %f sec" % (time.time() - start_time))
 
     n_dof = A.shape[0]
 
     logging.debug("Attempting to solve %dx%d system" % (n_dof, n_dof))
     start_time = time.time()
 
-    u = solve_linear_system(
-        A_bc, f_bc, solver=solver, solver_parameters=solver_parameters
+    u, info = solve_constrained_system(
+        A,
+        f,
+        dirichlet_dofs,
+        bc_method=bc_method,
+        solver=solver,
+        solver_parameters=solver_parameters,
+        return_info=True,
     )
     logging.debug("Solved system in %f sec" % (time.time() - start_time))
 
@@ -46,7 +64,10 @@ def solve(
     rhs_function = Function(matrix_assembler.mesh, matrix_assembler.function_size)
     rhs_function.set_vector(A.dot(u))
 
-    return function, rhs_function
+    if return_info:
+        return function, rhs_function, info
+    else:
+        return function, rhs_function
 
 
 def nonlinear_solve(
@@ -58,22 +79,33 @@ def nonlinear_solve(
     tol=1e-10,
     solver="scipy_sparse",
     solver_parameters={},
+    bc_method="identity",
+    residual_history=False,
+    return_info=False,
 ):
+    """Solves the nonlinear problem with Newton iterations. With return_info,
+    the list of SolverInfos of the linear solves is returned as a third value"""
 
     mesh = jacobian.mesh
     function_size = jacobian.function_size
     node_dofs = jacobian.node_dofs
 
+    solver_parameters = dict({"block_size": function_size}, **solver_parameters)
+    if residual_history:
+        solver_parameters["residual_history"] = True
+
     function = Function(mesh, function_size)
     if initial:
         function.vector = initial.vector.copy()
 
     rel_error = tol + 1
 
-    u_dirichlet = get_dirichlet_vector(mesh, node_dofs, function_size, dirichlet_bcs)
+    # The boundary conditions do not change during the iterations
+    dofs, values = get_dirichlet_dofs(mesh, node_dofs, function_size, dirichlet_bcs)
 
     # phi0 = function.vector.copy()
     n_iter = 0
+    infos = []
 
     while rel_error >= tol:
         old_vector = function.vector
@@ -95,26 +127,17 @@ def nonlinear_solve(
             "Finished assembling residual vector in %fs" % (time.time() - start)
         )
 
-        A_bc = get_modified_matrix(A, mesh, node_dofs, function_size, dirichlet_bcs)
-        constrained_dofs = get_constrained_dofs(
-            mesh, node_dofs, function_size, dirichlet_bcs
-        )
-
-        update_dirichlet = np.zeros(u_dirichlet.shape)
-
-        for n, constrained in enumerate(constrained_dofs):
-            if constrained:
-                update_dirichlet[n] = u_dirichlet[n] - old_vector[n]
-
-        f_bc = f - A.dot(update_dirichlet)
-
-        for n, constrained in enumerate(constrained_dofs):
-            if constrained:
-                f_bc[n] = update_dirichlet[n]
-
-        update_vector = solve_linear_system(
-            A_bc, f_bc, solver=solver, solver_parameters=solver_parameters
+        # The update brings the constrained dofs to their prescribed values
+        update_vector, info = solve_constrained_system(
+            A,
+            f,
+            (dofs, values - old_vector[dofs, 0]),
+            bc_method=bc_method,
+            solver=solver,
+            solver_parameters=solver_parameters,
+            return_info=True,
         )
+        infos.append(info)
 
         f_final = A.dot(update_vector)
 
@@ -141,111 +164,200 @@ def nonlinear_solve(
     residual_function = Function(mesh, function_size)
     residual_function.set_vector(f_final)
 
-    return function, residual_function
+    if return_info:
+        return function, residual_function, infos
+    else:
+        return function, residual_function
 
 
-def apply_bcs(matrix, rhs_vector, mesh, node_dofs, function_size, dirichlet_bcs):
-    matrix = matrix.copy()
-    rhs_vector = rhs_vector.copy()
+def apply_bcs(
+    matrix,
+    rhs_vector,
+    mesh,
+    node_dofs,
+    function_size,
+    dirichlet_bcs,
+    dirichlet_dofs=None,
+):
+    if dirichlet_dofs is None:
+        dirichlet_dofs = get_dirichlet_dofs(
+            mesh, node_dofs, function_size, dirichlet_bcs
+        )
+    dofs, values = dirichlet_dofs
+
+    return constrain_system(matrix, rhs_vector, dofs, values)
+
+
+def constrain_system(matrix, rhs_vector, dofs, values):
+    "Replaces the constrained equations with identity rows, keeping the symmetry"
+    rhs_vector = constrain_vector(matrix, rhs_vector, dofs, values)
+    return constrain_matrix(matrix, dofs), rhs_vector
+
+
+def constrain_vector(matrix, rhs_vector, dofs, values):
+    "Moves the constrained columns to the right hand side and sets the values"
+    u_dirichlet = np.zeros((matrix.shape[0], 1))
+    u_dirichlet[dofs, 0] = values
 
-    u_dirichlet = get_dirichlet_vector(mesh, node_dofs, function_size, dirichlet_bcs)
     rhs_vector = rhs_vector - matrix.dot(u_dirichlet)
+    rhs_vector[dofs, 0] = values
 
-    constrained_dofs = get_constrained_dofs(
-        mesh, node_dofs, function_size, dirichlet_bcs
-    )
+    return rhs_vector
 
-    for bc in dirichlet_bcs:
-        if bc.components:
-            components = bc.components
-        else:
-            components = range(function_size)
 
-        for n in mesh.nodes:
-            if not bc.position_bool(n.coor, 0):
-                continue
-            value = bc.value(n.coor)
-            for I_i, I in enumerate(node_dofs[n.idx]):
-                if not I_i in components:
-                    continue
-                for i in range(matrix.shape[0]):
-                    matrix[i, I] = 0.0
-                for i in range(matrix.shape[1]):
-                    matrix[I, i] = 0.0
+def constrain_matrix(matrix, dofs):
+    "Zeros the rows and columns of the given dofs and puts ones on their diagonal"
+    dofs = np.asarray(dofs, dtype=np.int64)
 
-                matrix[I, I] = 1.0
-                rhs_vector[I] = value[I_i]
+    if not issparse(matrix):
+        matrix = matrix.copy()
+        matrix[:, dofs] = 0.0
+        matrix[dofs, :] = 0.0
+        matrix[dofs, dofs] = 1.0
+        return matrix
 
-    return matrix, rhs_vector
+    # Mask the entries in place so that the sparsity structure is kept
+    matrix = csr_matrix(matrix, copy=True)
+    n_rows = matrix.shape[0]
 
+    constrained = np.zeros(n_rows, dtype=bool)
+    constrained[dofs] = True
 
-def get_modified_matrix(matrix, mesh, node_dofs, function_size, dirichlet_bcs):
-    matrix = matrix.copy()
+    rows = np.repeat(np.arange(n_rows), np.diff(matrix.indptr))
+    cols = matrix.indices
+    matrix.data[constrained[rows] | constrained[cols]] = 0.0
 
-    for bc in dirichlet_bcs:
-        if bc.components:
-            components = bc.components
-        else:
-            components = range(function_size)
-
-        for n in mesh.nodes:
-            if not bc.position_bool(n.coor, 0):
-                continue
-            value = bc.value(n.coor)
-            for I_i, I in enumerate(node_dofs[n.idx]):
-                if not I_i in components:
-                    continue
-                for i in range(matrix.shape[0]):
-                    matrix[i, I] = 0.0
-                for i in range(matrix.shape[1]):
-                    matrix[I, i] = 0.0
-
-                matrix[I, I] = 1.0
+    diagonal = constrained[rows] & (rows == cols)
+    matrix.data[diagonal] = 1.0
+
+    has_diagonal = np.zeros(n_rows, dtype=bool)
+    has_diagonal[rows[diagonal]] = True
+    missing = dofs[~has_diagonal[dofs]]
+
+    if len(missing) > 0:
+        missing_diagonal = np.zeros(n_rows)
+        missing_diagonal[missing] = 1.0
+        matrix = (matrix + diags(missing_diagonal, format="csr")).tocsr()
 
     return matrix
 
 
-def get_dirichlet_vector(mesh, node_dofs, function_size, dirichlet_bcs):
+def solve_constrained_system(
+    A,
+    b,
+    dirichlet_dofs,
+    bc_method="identity",
+    solver="scipy_sparse",
+    solver_parameters={},
+    return_info=False,
+):
+    """Solves the system with the given dofs constrained to the given values.
+    With the identity method, the constrained rows and columns are replaced
+    with identity rows. With the elimination method, only the free dofs are
+    solved for, which keeps the system symmetric"""
+    dofs, values = dirichlet_dofs
+
+    if bc_method == "identity":
+        A_bc, b_bc = constrain_system(A, b, dofs, values)
+        return solve_linear_system(
+            A_bc,
+            b_bc,
+            solver=solver,
+            solver_parameters=solver_parameters,
+            return_info=return_info,
+        )
+    elif bc_method == "elimination":
+        return solve_reduced_system(
+            A,
+            b,
+            dofs,
+            values,
+            solver=solver,
+            solver_parameters=solver_parameters,
+            return_info=return_info,
+        )
+    else:
+        raise Exception("Unknown bc method: %s" % bc_method)
+
+
+def solve_reduced_system(
+    A, b, dofs, values, solver="scipy_sparse", solver_parameters={}, return_info=False
+):
+    "Solves A_ff u_f = b_f - A_fc u_c for the free dofs and scatters back"
+    A_cc, A_fc, A_cf, A_ff, b_c, b_f = partition_system(A, b, dofs)
+
+    free_dofs = np.ones(A.shape[0], dtype=bool)
+    free_dofs[dofs] = False
+
+    u = np.zeros((A.shape[0], 1))
+    u[dofs, 0] = values
+
+    # Nothing is solved for when all dofs are constrained
+    info = SolverInfo(solver)
+
+    if A_ff.shape[0] > 0:
+        u_c = np.reshape(values, (-1, 1))
+        u[free_dofs], info = solve_linear_system(
+            A_ff,
+            b_f - A_fc.dot(u_c),
+            solver=solver,
+            solver_parameters=solver_parameters,
+            return_info=True,
+        )
+
+    if return_info:
+        return u, info
+    else:
+        return u
+
+
+def get_dirichlet_dofs(mesh, node_dofs, function_size, dirichlet_bcs):
+    """Evaluates the boundary conditions once and returns the sorted array of
+    constrained dofs together with their values. Where boundary conditions
+    overlap, the last one in the list wins"""
     system_size = len(mesh.nodes) * function_size
-    u_dirichlet = np.zeros((system_size, 1))
+    constrained = np.zeros(system_size, dtype=bool)
+    u_dirichlet = np.zeros(system_size)
 
     for bc in dirichlet_bcs:
         if bc.components:
-            components = bc.components
+            components = [i for i in range(function_size) if i in bc.components]
         else:
-            components = range(function_size)
+            components = list(range(function_size))
+
+        node_indices = bc.get_node_indices(mesh)
+        if len(node_indices) == 0 or len(components) == 0:
+            continue
 
-        for n in mesh.nodes:
-            if not bc.position_bool(n.coor, 0):
-                continue
-            value = bc.value(n.coor)
-            for I_i, I in enumerate(node_dofs[n.idx]):
-                if not I_i in components:
-                    continue
-                u_dirichlet[I] = value[I_i]
+        dofs = np.array([node_dofs[idx] for idx in node_indices], dtype=np.int64)
+        dofs = dofs[:, components]
+
+        constrained[dofs] = True
+        u_dirichlet[dofs] = bc.get_values(mesh, components)
+
+    dofs = np.flatnonzero(constrained)
+
+    return dofs, u_dirichlet[dofs]
+
+
+def get_dirichlet_vector(mesh, node_dofs, function_size, dirichlet_bcs):
+    system_size = len(mesh.nodes) * function_size
+    dofs, values = get_dirichlet_dofs(mesh, node_dofs, function_size, dirichlet_bcs)
+
+    u_dirichlet = np.zeros((system_size, 1))
+    u_dirichlet[dofs, 0] = values
 
     return u_dirichlet
 
 
 def get_constrained_dofs(mesh, node_dofs, function_size, dirichlet_bcs):
     system_size = len(mesh.nodes) * function_size
-    result = [False for i in range(system_size)]
-
-    for bc in dirichlet_bcs:
-        if bc.components:
-            components = bc.components
-        else:
-            components = range(function_size)
+    dofs, values = get_dirichlet_dofs(mesh, node_dofs, function_size, dirichlet_bcs)
 
-        for n in mesh.nodes:
-            if not bc.position_bool(n.coor, 0):
-                continue
-            for I_i, I in enumerate(node_dofs[n.idx]):
-                if not I_i in components:
-                    continue
-                result[I] = True
+    result = np.zeros(system_size, dtype=bool)
+    result[dofs] = True
 
-    return result
+    return result.tolist()
 
 
 # def apply_bcs(matrix, rhs_vector, function_space, dirichlet_bcs):
@@ -270,13 +382,17 @@ def get_constrained_dofs(mesh, node_dofs, function_size, dirichlet_bcs):
 #     return matrix, rhs_vector
 
 
-def solve_linear_system(A, b, solver="scipy_sparse", solver_parameters={}):
-    if solver == "scipy_sparse":
-        u = solve_scipy_sparse(A, b)
-    else:
-        raise Exception("Unknown solver: %s" % solver)
+def solve_linear_system(
+    A, b, solver="scipy_sparse", solver_parameters={}, return_info=False
+):
+    """Solves the system with one of the solvers in LINEAR_SOLVERS. The
+    returned SolverInfo holds the iteration count and residual history"""
+    u, info = run_linear_solver(A, b, solver, solver_parameters)
 
-    return u
+    if return_info:
+        return u, info
+    else:
+        return u
 
 
 def solve_scipy_sparse(A, b):
@@ -0,0 +1,67 @@
+import numpy as np
+import logging
+import time
+from scipy.sparse import csr_matrix
+
+
+class SparsityPattern:
+    def __init__(self, cell_indices, dofmaps, n_dofs):
+        start_time = time.time()
+
+        self.cell_indices = np.array(cell_indices, dtype=np.int64)
+        self.n_dofs = n_dofs
+
+        dofmaps = [np.array(dofmap, dtype=np.int64) for dofmap in dofmaps]
+        self.n_entries = sum([len(dofmap) ** 2 for dofmap in dofmaps])
+
+        if dofmaps:
+            rows = np.concatenate(
+                [np.repeat(dofmap, len(dofmap)) for dofmap in dofmaps]
+            )
+            cols = np.concatenate([np.tile(dofmap, len(dofmap)) for dofmap in dofmaps])
+        else:
+            rows = np.zeros(0, dtype=np.int64)
+            cols = np.zeros(0, dtype=np.int64)
+
+        # Sorting the linearized indices yields the entries in CSR order, and
+        # the inverse maps every element matrix entry to its slot in data
+        keys = rows * n_dofs + cols
+        unique_keys, scatter = np.unique(keys, return_inverse=True)
+
+        self.scatter = scatter.reshape(-1)
+        self.nnz = len(unique_keys)
+
+        if max(self.nnz, n_dofs) < np.iinfo(np.int32).max:
+            index_dtype = np.int32
+        else:
+            index_dtype = np.int64
+
+        self.indices = (unique_keys % n_dofs).astype(index_dtype)
+        self.indptr = np.zeros(n_dofs + 1, dtype=index_dtype)
+        np.cumsum(
+            np.bincount(unique_keys // n_dofs, minlength=n_dofs),
+            out=self.indptr[1:],
+        )
+
+        logging.debug(
+            "Computed sparsity pattern with %d nonzeros in %f sec"
+            % (self.nnz, time.time() - start_time)
+        )
+
+    def matches(self, cell_indices, n_dofs):
+        return n_dofs == self.n_dofs and np.array_equal(self.cell_indices, cell_indices)
+
+    def get_data(self, values):
+        "Sum flattened element matrices into the data array of the pattern"
+        return np.bincount(self.scatter, weights=values, minlength=self.nnz)
+
+    def create_matrix(self, values):
+        return self.create_matrix_from_data(self.get_data(values))
+
+    def create_matrix_from_data(self, data):
+        result = csr_matrix(
+            (data, self.indices.copy(), self.indptr.copy()),
+            shape=(self.n_dofs, self.n_dofs),
+        )
+        result.has_sorted_indices = True
+        return result
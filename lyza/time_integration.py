@@ -1,10 +1,11 @@
 from lyza.analytic_solution import get_analytic_solution_vector
-from lyza.solver import apply_bcs, solve_scipy_sparse
+from lyza.solver import constrain_matrix, constrain_vector, get_dirichlet_dofs
 from lyza.function import Function
-from lyza.vtk import VTKFile
+from lyza.vtk import AsyncVTKWriter
 import logging
 import numpy as np
-import progressbar
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
 
 
 def time_array(t_init, t_max, delta_t):
@@ -33,13 +34,22 @@ def implicit_euler(
     solution_vector = u.vector
     previous_solution_vector = None
 
+    # The factorization is reused while the step size and constraints stay the same
+    factorization = None
+    factorized_delta_t = None
+    factorized_dofs = None
+
+    import progressbar
+
     bar = progressbar.ProgressBar(max_value=len(t_array))
 
     if out_prefix:
+        # The files are written while the next steps are computed
+        writer = AsyncVTKWriter()
+
         # u.set_vector(solution_vector)
         u.set_label("u")
-        ofile = VTKFile("%s%05d.vtk" % (out_prefix, 0))
-        ofile.write(mesh, u)
+        writer.submit("%s%05d.vtk" % (out_prefix, 0), mesh, u)
 
     for i in range(1, len(t_array)):
         t = t_array[i]
@@ -47,28 +57,41 @@ def implicit_euler(
 
         b_form.set_time(t)
         b = b_form.assemble()
-        matrix = M + delta_t * A
-        vector = M.dot(solution_vector) + delta_t * b
 
         for bc in dirichlet_bcs:
             bc.set_time(t)
 
-        matrix_bc, vector_bc = apply_bcs(
-            matrix, vector, mesh, node_dofs, function_size, dirichlet_bcs
-        )
-        # matrix_bc, vector_bc = apply_bcs(matrix, vector, u.function_space, dirichlet_bcs)
+        dofs, values = get_dirichlet_dofs(mesh, node_dofs, function_size, dirichlet_bcs)
+
+        if (
+            factorization is None
+            or not np.isclose(delta_t, factorized_delta_t, rtol=1e-12, atol=0)
+            or not np.array_equal(dofs, factorized_dofs)
+        ):
+            matrix = M + delta_t * A
+            factorization = splu(csc_matrix(constrain_matrix(matrix, dofs)))
+            factorized_delta_t = delta_t
+            factorized_dofs = dofs
+            logging.debug("Factorized system matrix for delta_t = %e" % delta_t)
+
+        vector = M.dot(solution_vector) + delta_t * b
+
+        # Only the right hand side changes, the matrix is already factorized
+        vector_bc = constrain_vector(matrix, vector, dofs, values)
         previous_solution_vector = solution_vector
-        solution_vector = solve_scipy_sparse(matrix_bc, vector_bc)
+        solution_vector = factorization.solve(vector_bc)
 
         if out_prefix:
             u.set_vector(solution_vector)
-            ofile = VTKFile("%s%05d.vtk" % (out_prefix, i))
-            ofile.write(mesh, u)
+            writer.submit("%s%05d.vtk" % (out_prefix, i), mesh, u)
 
         bar.update(i + 1)
         # logging.info('T = %f'%(t))
     bar.finish()
 
+    if out_prefix:
+        writer.close()
+
     u.set_vector(solution_vector)
     f = Function(mesh, function_size)
     f.set_vector(
@@ -39,6 +39,22 @@ class FunctionVector(VectorAssembler):
 
         return f
 
+    def calculate_element_vectors(self, batch):
+        N = batch.get_quantity("N")[:, :, :, 0]
+        XG = batch.get_quantity("XG")[:, :, :, 0]
+        WDETJ = batch.get_weights()
+
+        f_val = np.array(
+            [
+                [self.function(coor.tolist(), self.time) for coor in cell_coors]
+                for cell_coors in XG
+            ]
+        )
+
+        f = np.einsum("xqi, xqj, xq -> xji", f_val, N, WDETJ)
+
+        return f.reshape(len(batch), -1, 1)
+
 
 class PointLoadVector(VectorAssembler):
     def set_param(self, position_function, value):
@@ -76,6 +92,9 @@ class ZeroVector(VectorAssembler):
 
         return f
 
+    def calculate_element_vectors(self, batch):
+        return np.zeros((len(batch), batch.dofs.shape[1], 1))
+
 
 class InelasticityResidualVector(VectorAssembler):
     def calculate_element_vector(self, cell):
@@ -101,6 +120,15 @@ class InelasticityResidualVector(VectorAssembler):
 
         return f
 
+    def calculate_element_vectors(self, batch):
+        B = batch.get_quantity("B")
+        SIG = batch.get_quantity("SIG")
+        WDETJ = batch.get_weights()
+
+        f = -np.einsum("xqab, xqib, xq -> xia", SIG, B, WDETJ)
+
+        return f.reshape(len(batch), -1, 1)
+
 
 class HyperelasticityResidual(VectorAssembler):
     def calculate_element_vector(self, cell):
@@ -134,3 +162,12 @@ class HyperelasticityResidual(VectorAssembler):
             f += f_higher
 
         return f
+
+    def calculate_element_vectors(self, batch):
+        BBAR = batch.get_quantity("BBAR")
+        TAU = batch.get_quantity("TAU")
+        WDETJ = batch.get_weights()
+
+        f = -np.einsum("xqab, xqib, xq -> xia", TAU, BBAR, WDETJ)
+
+        return f.reshape(len(batch), -1, 1)
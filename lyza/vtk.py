@@ -1,127 +1,503 @@
 import logging
+import os
+import queue
+import threading
+import time
+import zlib
+import numpy as np
 import lyza.cells as cells
+from lyza.domain import DefaultDomain
+
+VTK_CELL_TYPES = [(cells.Quad, 9), (cells.Hex, 12)]
+
+# XDMF topology names and mixed topology codes of the VTK cell types
+XDMF_CELL_TYPES = {9: ("Quadrilateral", 5), 12: ("Hexahedron", 9)}
+
+
+def get_vtk_arrays(mesh):
+    """Returns the arrays of the non-boundary cells that VTK files consist of:
+    the flat connectivity, the offsets of the end of every cell in it and the
+    cell types"""
+    cell_indices = DefaultDomain().get_cell_indices(mesh)
+    cell_classes = {}
+
+    for cell_type in set([type(mesh.cells[idx]) for idx in cell_indices]):
+        for vtk_class, vtk_type in VTK_CELL_TYPES:
+            if issubclass(cell_type, vtk_class):
+                cell_classes[cell_type] = vtk_type
+                break
+        else:
+            raise Exception("Invalid cell for VTK file")
+
+    n_nodes = np.array(
+        [len(mesh.cells[idx].nodes) for idx in cell_indices], dtype=np.int64
+    )
+    types = np.array(
+        [cell_classes[type(mesh.cells[idx])] for idx in cell_indices], dtype=np.uint8
+    )
+    offsets = np.cumsum(n_nodes)
+    connectivity = np.zeros(offsets[-1] if len(offsets) else 0, dtype=np.int64)
+
+    # Node indices of the cells of each type at once
+    cell_types = np.array([type(mesh.cells[idx]) for idx in cell_indices])
+    for cell_type in cell_classes:
+        mask = cell_types == cell_type
+        node_indices = mesh.get_cell_node_indices(cell_indices[mask])
+        positions = (offsets - n_nodes)[mask][:, None] + np.arange(
+            node_indices.shape[1]
+        )
+        connectivity[positions] = node_indices
+
+    return connectivity, offsets, types
+
+
+def get_point_values(function):
+    "Returns the nodal values of the function with shape (n_node, function_size)"
+    return function.vector[np.array(function.node_dofs, dtype=np.int64), 0]
+
+
+def pad_vectors(values):
+    "Pads 2D vectors with a zero third component, since VTK vectors have 3"
+    if values.shape[1] == 2:
+        values = np.hstack([values, np.zeros((len(values), 1), dtype=values.dtype)])
+
+    return values
+
+
+def check_functions(mesh, functions):
+    for function in functions:
+        if function.mesh != mesh:
+            raise Exception("Function does not match input mesh")
+
+        if not function.label:
+            raise Exception("Function is not labeled")
+
+
+def get_mesh_and_functions(mesh, functions):
+    if not mesh and not functions:
+        raise Exception("Input either a mesh or a function")
+
+    if not isinstance(functions, list):
+        functions = [functions]
+
+    if not mesh:
+        mesh = functions[0].mesh
+
+    check_functions(mesh, functions)
+
+    return mesh, functions
+
+
+def format_rows(array, format):
+    "Formats the rows of a 2D array, joining the values with spaces"
+    if array.size == 0:
+        return ""
+
+    line = " ".join([format] * array.shape[1]) + "\n"
+    return (line * len(array)) % tuple(array.ravel())
 
 
 class VTKFile:
-    def __init__(self, path):
+    "Legacy VTK file, written in ASCII or in big endian binary"
+
+    def __init__(self, path, binary=False):
         self.path = path
+        self.binary = binary
 
     def calculate_n_cell_data(self, mesh):
-        result = 0
-        for e in mesh.cells:
-            if e.is_boundary:
-                continue
-            result += len(e.nodes) + 1
-
-        return result
+        connectivity, offsets, types = get_vtk_arrays(mesh)
+        return len(connectivity) + len(offsets)
 
     def write(self, mesh=None, functions=[]):
-        if not mesh and not functions:
-            raise Exception("Input either a mesh or a function")
-        elif not mesh:
-            mesh = functions[0].mesh
-
-        if not isinstance(functions, list):
-            functions = [functions]
+        mesh, functions = get_mesh_and_functions(mesh, functions)
 
         logging.info("Writing %s" % self.path)
 
-        f = open(self.path, "w")
+        connectivity, offsets, types = get_vtk_arrays(mesh)
+        n_points = len(mesh.nodes)
+        n_cells = len(types)
 
-        f.write("# vtk DataFile Version 3.1\n")
-        f.write("LYZA Output\n")
-        f.write("ASCII\n")
+        # Every cell is stored as its number of nodes followed by the nodes
+        n_nodes = np.diff(offsets, prepend=0)
+        count_positions = offsets - n_nodes + np.arange(n_cells)
+        is_count = np.zeros(len(connectivity) + n_cells, dtype=bool)
+        is_count[count_positions] = True
 
-        f.write("DATASET UNSTRUCTURED_GRID\n")
-        # f.write('DATASET POLYDATA\n')
+        cell_data = np.zeros(len(is_count), dtype=np.int64)
+        cell_data[is_count] = n_nodes
+        cell_data[~is_count] = connectivity
 
-        n_points = len(mesh.nodes)
-        n_cells = len([i for i in mesh.cells if not i.is_boundary])
-        f.write("POINTS  " + repr(n_points) + " FLOAT\n")
-
-        for n in mesh.nodes:
-            f.write("%.6e %.6e %.6e\n" % (n.coor[0], n.coor[1], n.coor[2]))
-
-        f.write("\nCELLS %d %d\n" % (n_cells, self.calculate_n_cell_data(mesh)))
-        for e in mesh.cells:
-            if e.is_boundary:
-                continue
-            if isinstance(e, cells.Quad):
-                f.write("4 ")
-            elif isinstance(e, cells.Hex):
-                f.write("8 ")
+        with open(self.path, "wb") as f:
+            f.write(b"# vtk DataFile Version 3.1\n")
+            f.write(b"LYZA Output\n")
+            f.write(b"BINARY\n" if self.binary else b"ASCII\n")
+
+            f.write(b"DATASET UNSTRUCTURED_GRID\n")
+            f.write(("POINTS  %d FLOAT\n" % n_points).encode())
+            self.write_array(f, mesh.coordinates, "%.6e", ">f4")
+
+            f.write(("\nCELLS %d %d\n" % (n_cells, len(cell_data))).encode())
+            if self.binary:
+                self.write_array(f, cell_data, None, ">i4")
             else:
-                raise Exception("Invalid cell for VTK file")
-
-            for k in e.nodes:
-                f.write("%d " % (k.idx))
-            f.write("\n")
-
-        f.write("\nCELL_TYPES " + repr(n_cells) + "\n")
-        for e in mesh.cells:
-            if e.is_boundary:
-                continue
-            if isinstance(e, cells.Quad):
-                f.write("9 ")
-            elif isinstance(e, cells.Hex):
-                f.write("12 ")
+                lines = np.split(cell_data, count_positions[1:])
+                f.write(
+                    "".join(["%s \n" % " ".join(map(str, i)) for i in lines]).encode()
+                )
+
+            f.write(("\nCELL_TYPES %d\n" % n_cells).encode())
+            if self.binary:
+                self.write_array(f, types, None, ">i4")
             else:
-                raise Exception("Invalid cell for VTK file")
+                f.write("".join(["%d " % i for i in types]).encode())
 
-        if functions:
-            f.write("\n\nPOINT_DATA %d\n" % (n_points))
+            if functions:
+                f.write(("\n\nPOINT_DATA %d\n" % n_points).encode())
 
             for function in functions:
-                # V = function.function_space
+                self.write_function(f, function, n_points)
+
+    def write_function(self, f, function, n_points):
+        dim = function.function_size
+        values = get_point_values(function)
+
+        if dim == 1:
+            f.write(("SCALARS %s float\n" % function.label).encode())
+            f.write(b"LOOKUP_TABLE default\n")
+        elif dim == 2 or dim == 3:
+            f.write(("VECTORS %s float\n" % function.label).encode())
+            values = pad_vectors(values)
+        else:
+            f.write(b"FIELD FieldData 1\n")
+            f.write(("%s %d %d float\n" % (function.label, dim, n_points)).encode())
+
+        self.write_array(f, values, "%.6e", ">f4")
+        f.write(b"\n")
+
+    def write_array(self, f, array, format, dtype):
+        if self.binary:
+            f.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+            f.write(b"\n")
+        else:
+            f.write(format_rows(np.reshape(array, (len(array), -1)), format).encode())
+
+
+class VTUFile:
+    """VTK XML UnstructuredGrid file with the arrays appended as raw binary
+    data, optionally compressed with zlib"""
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        self.compress = compress
+
+    def encode_array(self, array):
+        "Returns the array as a block of appended data with its header"
+        data = np.ascontiguousarray(array).tobytes()
+
+        if not self.compress:
+            return np.array([len(data)], dtype="<u8").tobytes() + data
+
+        # A single block, so the last block has the full size
+        compressed = zlib.compress(data)
+        header = [1, len(data), len(data), len(compressed)]
+        return np.array(header, dtype="<u8").tobytes() + compressed
+
+    def write(self, mesh=None, functions=[]):
+        mesh, functions = get_mesh_and_functions(mesh, functions)
+
+        logging.info("Writing %s" % self.path)
+
+        connectivity, offsets, types = get_vtk_arrays(mesh)
+
+        blocks = []
+        elements = []
+
+        def add_array(array, name, n_components=1):
+            offset = sum([len(i) for i in blocks])
+            blocks.append(self.encode_array(array))
+            type_name = {
+                np.dtype("<f8"): "Float64",
+                np.dtype("<i8"): "Int64",
+                np.dtype("uint8"): "UInt8",
+            }[array.dtype]
+            elements.append(
+                '<DataArray type="%s" Name="%s" NumberOfComponents="%d" '
+                'format="appended" offset="%d"/>'
+                % (type_name, name, n_components, offset)
+            )
+
+        for function in functions:
+            values = pad_vectors(get_point_values(function).astype("<f8"))
+            add_array(values, function.label, values.shape[1])
+        point_data = elements
+        elements = []
+
+        add_array(mesh.coordinates.astype("<f8"), "Points", 3)
+        points = elements
+        elements = []
+
+        add_array(connectivity.astype("<i8"), "connectivity")
+        add_array(offsets.astype("<i8"), "offsets")
+        add_array(types, "types")
+        cell_arrays = elements
+
+        if self.compress:
+            compressor = ' compressor="vtkZLibDataCompressor"'
+        else:
+            compressor = ""
+
+        header = "\n".join(
+            [
+                '<?xml version="1.0"?>',
+                '<VTKFile type="UnstructuredGrid" version="1.0" '
+                'byte_order="LittleEndian" header_type="UInt64"%s>' % compressor,
+                "<UnstructuredGrid>",
+                '<Piece NumberOfPoints="%d" NumberOfCells="%d">'
+                % (len(mesh.nodes), len(types)),
+                "<PointData>",
+            ]
+            + point_data
+            + ["</PointData>", "<Points>"]
+            + points
+            + ["</Points>", "<Cells>"]
+            + cell_arrays
+            + [
+                "</Cells>",
+                "</Piece>",
+                "</UnstructuredGrid>",
+                '<AppendedData encoding="raw">',
+                "_",
+            ]
+        )
+
+        with open(self.path, "wb") as f:
+            f.write(header.encode())
+            for block in blocks:
+                f.write(block)
+            f.write(b"\n</AppendedData>\n</VTKFile>\n")
+
+
+class AsyncVTKWriter:
+    """Writes VTK files on a background thread, so that a time stepping loop
+    can continue while the previous step is written. Submitted functions are
+    copied. submit blocks while max_queue files are waiting to be written, and
+    blocked_time is the total time it spent blocked"""
+
+    def __init__(self, file_class=VTKFile, max_queue=2, **file_parameters):
+        self.file_class = file_class
+        self.file_parameters = file_parameters
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.blocked_time = 0.0
+        self.n_written = 0
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, path, mesh=None, functions=[]):
+        self.raise_error()
+
+        mesh, functions = get_mesh_and_functions(mesh, functions)
+        functions = [function.copy() for function in functions]
+
+        start_time = time.time()
+        self.queue.put((path, mesh, functions))
+        self.blocked_time += time.time() - start_time
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+
+            try:
+                if item is None:
+                    return
+
+                path, mesh, functions = item
+                self.file_class(path, **self.file_parameters).write(mesh, functions)
+                self.n_written += 1
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def flush(self):
+        "Waits until all submitted files are written"
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        logging.debug(
+            "Wrote %d files, blocked for %f sec" % (self.n_written, self.blocked_time)
+        )
+        self.raise_error()
 
-                if function.mesh != mesh:
-                    raise Exception("Function does not match input mesh")
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class VTKTimeSeries:
+    """Writes the functions of a time stepping loop as one time series that
+    ParaView opens as a whole, writing only every stride-th step.
+
+    With shared_geometry, the points and cells are written once to the binary
+    file <prefix>.bin, to which every step appends only its point data. The
+    XDMF file <prefix>.xdmf indexes the arrays in it with their times.
+    Otherwise every step is written to a VTU file, and <prefix>.pvd is the
+    index of the steps with their times"""
+
+    def __init__(self, prefix, stride=1, shared_geometry=True, compress=False):
+        self.prefix = prefix
+        self.stride = stride
+        self.shared_geometry = shared_geometry
+        self.compress = compress
+
+        self.n_calls = 0
+        self.steps = []
+        self.mesh = None
+
+    def write(self, t, mesh=None, functions=[]):
+        "Returns whether the step was written"
+        mesh, functions = get_mesh_and_functions(mesh, functions)
+
+        self.n_calls += 1
+        if (self.n_calls - 1) % self.stride != 0:
+            return False
+
+        if self.mesh is None:
+            self.mesh = mesh
+        elif mesh is not self.mesh:
+            raise Exception("Time series are written for a single mesh")
+
+        logging.info("Writing step %d of %s" % (len(self.steps), self.prefix))
+
+        if self.shared_geometry:
+            self.write_xdmf_step(t, mesh, functions)
+            self.write_xdmf_index()
+        else:
+            self.write_vtu_step(t, mesh, functions)
+            self.write_pvd_index()
+
+        return True
+
+    def write_vtu_step(self, t, mesh, functions):
+        path = "%s_%05d.vtu" % (self.prefix, len(self.steps))
+        VTUFile(path, compress=self.compress).write(mesh, functions)
+        self.steps.append((t, os.path.basename(path)))
+
+    def write_pvd_index(self):
+        lines = ['<?xml version="1.0"?>', '<VTKFile type="Collection" version="0.1">']
+        lines.append("<Collection>")
+        for t, path in self.steps:
+            lines.append('<DataSet timestep="%.16g" part="0" file="%s"/>' % (t, path))
+        lines += ["</Collection>", "</VTKFile>", ""]
+
+        with open(self.prefix + ".pvd", "w") as f:
+            f.write("\n".join(lines))
+
+    def write_xdmf_step(self, t, mesh, functions):
+        path = self.prefix + ".bin"
+
+        if not self.steps:
+            connectivity, offsets, types = get_vtk_arrays(mesh)
+
+            if len(set(types.tolist())) == 1:
+                topology_type = XDMF_CELL_TYPES[types[0]][0]
+                topology = connectivity
+            else:
+                # Mixed topologies prefix the nodes of every cell with its code
+                topology_type = "Mixed"
+                codes = np.array([XDMF_CELL_TYPES[i][1] for i in types.tolist()])
+                topology = np.insert(
+                    connectivity, offsets - np.diff(offsets, prepend=0), codes
+                )
+
+            with open(path, "wb") as f:
+                f.write(mesh.coordinates.astype("<f8").tobytes())
+                f.write(topology.astype("<i8").tobytes())
+
+            self.geometry = {
+                "n_points": len(mesh.nodes),
+                "n_cells": len(types),
+                "topology_type": topology_type,
+                "topology_size": len(topology),
+                "topology_offset": mesh.coordinates.size * 8,
+                "n_nodes": len(connectivity) // max(len(types), 1),
+            }
+
+        attributes = []
+        with open(path, "ab") as f:
+            for function in functions:
+                values = pad_vectors(get_point_values(function).astype("<f8"))
 
-                if not function.label:
-                    raise Exception("Function is not labeled")
+                attributes.append((function.label, values.shape[1], f.tell()))
+                f.write(values.tobytes())
 
-                dim = function.function_size
+        self.steps.append((t, attributes))
 
-                if dim == 1:
-                    f.write("SCALARS %s float\n" % function.label)
-                    f.write("LOOKUP_TABLE default\n")
+    def get_data_item(self, dimensions, number_type, offset):
+        return (
+            '<DataItem Dimensions="%s" NumberType="%s" Precision="8" Format="Binary" '
+            'Endian="Little" Seek="%d">%s</DataItem>'
+            % (dimensions, number_type, offset, os.path.basename(self.prefix + ".bin"))
+        )
 
-                    for n, i in enumerate(mesh.nodes):
-                        val = function.vector[function.node_dofs[n][0]]
-                        f.write("%.6e\n" % val)
-                    f.write("\n")
+    def write_xdmf_index(self):
+        geometry = self.geometry
+        n_points = geometry["n_points"]
 
-                elif dim == 2 or dim == 3:
-                    f.write("VECTORS %s float\n" % function.label)
+        if geometry["topology_type"] == "Mixed":
+            dimensions = "%d" % geometry["topology_size"]
+        else:
+            dimensions = "%d %d" % (geometry["n_cells"], geometry["n_nodes"])
 
-                    for n, i in enumerate(mesh.nodes):
-                        vector = [0.0, 0.0, 0.0]
-                        for j, k in enumerate(function.node_dofs[n]):
-                            vector[j] = function.vector[k]
+        topology = [
+            '<Topology TopologyType="%s" NumberOfElements="%d">'
+            % (geometry["topology_type"], geometry["n_cells"]),
+            self.get_data_item(dimensions, "Int", geometry["topology_offset"]),
+            "</Topology>",
+            '<Geometry GeometryType="XYZ">',
+            self.get_data_item("%d 3" % n_points, "Float", 0),
+            "</Geometry>",
+        ]
 
-                        f.write("%.6e %.6e %.6e\n" % (vector[0], vector[1], vector[2]))
-                    f.write("\n")
-                elif dim > 3:
-                    f.write("FIELD FieldData 1\n")
-                    f.write("%s %d %d float\n" % (function.label, dim, n_points))
+        lines = [
+            '<?xml version="1.0"?>',
+            '<Xdmf Version="3.0">',
+            "<Domain>",
+            '<Grid Name="TimeSeries" GridType="Collection" CollectionType="Temporal">',
+        ]
 
-                    for n, i in enumerate(mesh.nodes):
-                        for j, k in enumerate(function.node_dofs[n]):
-                            f.write("%.6e" % function.vector[k])
-                            if j < dim - 1:
-                                f.write(" ")
-                            elif j == dim - 1:
-                                f.write("\n")
-                    f.write("\n")
+        for idx, (t, attributes) in enumerate(self.steps):
+            lines += ['<Grid Name="step_%d" GridType="Uniform">' % idx]
+            lines += ['<Time Value="%.16g"/>' % t]
+            lines += topology
 
-                else:
-                    raise Exception()
+            for label, dim, offset in attributes:
+                attribute_type = {1: "Scalar", 3: "Vector"}
+                lines += [
+                    '<Attribute Name="%s" AttributeType="%s" Center="Node">'
+                    % (label, attribute_type.get(dim, "Matrix")),
+                    self.get_data_item("%d %d" % (n_points, dim), "Float", offset),
+                    "</Attribute>",
+                ]
 
-        # f.write('CELL_DATA %d\n'%(n_cells))
+            lines += ["</Grid>"]
 
-        # f.write('VECTORS elem_local_force float\n')
-        # for e in self.elems:
-        #     f.write('%.6e %.6e %.6e\n'%(e.local_forces[0], e.local_forces[1], e.local_forces[2]))
-        # f.write('\n')
+        lines += ["</Grid>", "</Domain>", "</Xdmf>", ""]
 
-        f.close()
+        with open(self.prefix + ".xdmf", "w") as f:
+            f.write("\n".join(lines))